@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+import numpy as np
+
+"""
+The Arrow IPC format of the training shards: written by preprocessing.py (ArrowShardWriter) and
+read by the training script, where it is also the input_fn of the arrow batch transform requests.
+The pipeline mounts this module in the processing steps and uploads it with the training code
+"""
+
+# content type and schema metadata key of the arrow shards
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.file'
+ARROW_METADATA_KEY = 'wind_turbine'
+
+def import_pyarrow():
+    """ pyarrow is only needed by the arrow shards """
+    try:
+        import pyarrow
+    except ImportError:
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "pyarrow"])
+        import pyarrow
+    import pyarrow.ipc
+    return pyarrow
+
+def read_arrow(source):
+    """
+    Reads an arrow shard (file path or buffer) into an array (n, features, 10, 10).
+    Files are memory mapped and the record batches are decompressed one at a time
+    """
+    pa = import_pyarrow()
+    if isinstance(source, str):
+        source = pa.memory_map(source, 'r')
+    else:
+        source = pa.BufferReader(source)
+    reader = pa.ipc.open_file(source)
+    sample_shape = json.loads(reader.schema.metadata[ARROW_METADATA_KEY.encode()])['sample_shape']
+    batches = [reader.get_batch(i).column(0).flatten().to_numpy(zero_copy_only=False).reshape([-1] + sample_shape)
+               for i in range(reader.num_record_batches)]
+    return np.concatenate(batches) if len(batches) > 0 else np.empty([0] + sample_shape, dtype=np.float32)
@@ -0,0 +1,345 @@
+import argparse
+import cProfile
+import filecmp
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pywt
+
+import preprocessing as pp
+import signal_processing as sp
+
+"""
+Per-stage benchmark of preprocessing.py on synthetic telemetry.
+Each stage (csv parse, date parse, euler, denoise, normalize, windowing, save) runs
+under cProfile and tracemalloc and reports its throughput and peak memory.
+The shared signal processing module is also checked against the original implementations
+and its copies in the detector and in the simulator must be identical, so skew is caught.
+The simulator copies of the detector modules (EDGE_SHARED_MODULES) are checked the same way.
+The training dataset and statistics of the full mode are checked against a frozen copy of the
+original preprocessing.py, on --baseline-rows samples split in two input files.
+
+    python3 benchmark.py --rows 1000000 --output-dir ./benchmark
+    python3 benchmark.py --rows 1000000 --baseline ./benchmark/benchmark.json
+
+With --baseline it exits with an error when a stage is slower than the
+baseline by more than --max-slowdown, or when a parity check fails.
+"""
+
+DEFAULT_EDGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '../../../01-model-deploy/algorithms/inference/aws.samples.windturbine.detector/inference')
+
+DEFAULT_SIMULATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '../../../01-model-deploy/fleet_simulator')
+
+# detector modules copied in the simulator, so the simulated fleet scores as the edge
+EDGE_SHARED_MODULES = ['scoring.py', 'scheduler.py']
+
+# max abs diff allowed for each check (library_copies: number of copies that differ)
+PARITY_TOLERANCE = {
+    'euler': 1e-9,
+    'windowing': 0.0,
+    'window_preprocessor': 1e-3,  # float32 on the edge
+    'library_copies': 0,
+    # float32 features vs the float64 original; the statistics are relative to std
+    'baseline_dataset': 1e-3,
+    'baseline_statistics': 1e-5,
+}
+
+
+def make_telemetry(path, rows, seed=42):
+    """ Writes a gzipped telemetry export with `rows` synthetic samples (10 per second) """
+    rng = np.random.RandomState(seed)
+    q = np.cumsum(rng.normal(scale=0.01, size=(rows, 4)), axis=0) + [0.0, 0.0, 0.0, 1.0]
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    event_time = pd.Timestamp('2021-01-01') + pd.to_timedelta(np.arange(rows) * 100, unit='ms')
+    df = pd.DataFrame({
+        'eventTime': event_time.strftime(pp.DATE_FORMAT),
+        'qx': q[:, 0], 'qy': q[:, 1], 'qz': q[:, 2], 'qw': q[:, 3],
+        'wind_speed_rps': np.abs(np.cumsum(rng.normal(scale=0.05, size=rows))) + rng.normal(scale=0.3, size=rows),
+        'rps': np.abs(np.cumsum(rng.normal(scale=0.05, size=rows))) + rng.normal(scale=0.3, size=rows),
+        'voltage': 200 + np.cumsum(rng.normal(scale=0.5, size=rows)) + rng.normal(scale=5.0, size=rows),
+    })
+    df.to_csv(path, index=False, compression='gzip')
+
+
+class StageRunner(object):
+    """
+    Runs the stages, measuring time, peak memory (tracemalloc) and a cProfile dump for each one.
+    Each stage runs `repeat` times and the fastest run is reported, to keep the comparisons stable
+    """
+    def __init__(self, output_dir, repeat=3):
+        self.output_dir = output_dir
+        self.repeat = max(1, repeat)
+        self.results = []
+
+    def run(self, name, rows, fn, *args):
+        elapsed_time, peak = float('inf'), 0
+        for _ in range(self.repeat):
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            profiler.enable()
+            result = fn(*args)
+            profiler.disable()
+            elapsed_time = min(elapsed_time, time.perf_counter() - start_time)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        profiler.dump_stats(os.path.join(self.output_dir, '%s.prof' % name))
+
+        stage = {
+            'stage': name,
+            'rows': rows,
+            'seconds': elapsed_time,
+            'rows_per_second': rows / elapsed_time if elapsed_time > 0 else float('inf'),
+            'peak_mb': peak / 1024.0 / 1024.0
+        }
+        self.results.append(stage)
+        print("%-20s rows=%d; elapsed_time=%.3fs; rows_per_second=%.0f; peak=%.1fMB" % (
+            name, rows, elapsed_time, stage['rows_per_second'], stage['peak_mb']))
+        return result
+
+
+def windowing(data, time_steps, step):
+    """ The windowing of write_dataset on an in-memory (rows x features) array """
+    return pp.to_model_input(np.nan_to_num(pp.sliding_windows(data, time_steps, step), copy=True, nan=0.0))
+
+
+def save(x, output_path, output_format, shard_bytes):
+    sample_bytes = x[0].nbytes
+    sizes = pp.get_shard_sizes(len(x), sample_bytes, shard_bytes)
+    writer_class = pp.SHARD_WRITERS[output_format]
+    paths = [os.path.join(output_path, 'wind_turbine_%02d%s' % (i, writer_class.extension)) for i in range(len(sizes))]
+    writer = writer_class(paths, sizes, x.shape[1:])
+    offset = 0
+    for i, size in enumerate(sizes):
+        writer.write(i, 0, x[offset:offset + size])
+        offset += size
+    writer.close()
+    return sizes
+
+
+def run_stages(runner, telemetry_path, rows, args):
+    time_steps = args.interval * args.time_steps
+    columns = runner.run('csv_parse', rows, lambda: pd.read_csv(
+        telemetry_path, compression='gzip', usecols=pp.COLUMNS, dtype=pp.DTYPES))
+    runner.run('date_parse', rows, lambda: pd.to_datetime(columns['eventTime'], format=pp.DATE_FORMAT))
+
+    def euler():
+        roll, pitch, yaw = pp.euler_from_quaternion(
+            columns['qx'].values, columns['qy'].values, columns['qz'].values, columns['qw'].values)
+        return np.stack([roll, pitch, yaw, columns['wind_speed_rps'].values,
+                         columns['rps'].values, columns['voltage'].values], axis=1).astype(np.float32)
+    features = runner.run('euler', rows, euler)
+    raw_std = pp.RunningStats(features.shape[1]).update(features).std
+
+    def denoise():
+        out = np.empty_like(features)
+        for i in range(features.shape[1]):
+            pp.wavelet_denoise_blocks(features[:, i], 'db6', raw_std[i], args.denoise_block_size, out=out[:, i])
+        return out
+    denoised = runner.run('denoise', rows, denoise)
+    stats = pp.RunningStats(denoised.shape[1]).update(denoised)
+
+    normalized = runner.run('normalize', rows, lambda: (denoised - stats.mean.astype(np.float32)) / stats.std.astype(np.float32))
+    x = runner.run('windowing', rows, windowing, normalized, time_steps, args.step)
+    with tempfile.TemporaryDirectory() as output_path:
+        runner.run('save', rows, save, x, output_path, args.output_format, int(args.shard_size_mb * 1024 * 1024))
+    return features, denoised, raw_std, stats
+
+
+def reference_euler(x, y, z, w):
+    """ The original scalar conversion (math module), one sample at a time """
+    t2 = max(-1.0, min(1.0, 2.0 * (w * y - z * x)))
+    return (math.atan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y)), math.asin(t2),
+            math.atan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z)))
+
+
+def reference_denoise(data, raw_std):
+    """ The original wavelet_denoise, frozen: a full wavelet transform of the whole feature """
+    wavelet = pywt.Wavelet('db6')
+    levels = min(5, (np.floor(np.log2(data.shape[0]))).astype(int))
+    threshold = raw_std * np.sqrt(2 * np.log2(data.size))
+    coeffs = [pywt.threshold(c, threshold, mode='soft') for c in pywt.wavedec(data, wavelet, level=levels)]
+    return pywt.waverec(coeffs, wavelet)
+
+
+def reference_window(buffer, raw_std, mean, std, time_steps, step):
+    """ The original float64 detector path, per sample, for the latest window of a buffer of raw samples """
+    data = np.array([list(reference_euler(*row[:4])) + list(row[4:7]) for row in np.array(buffer, dtype=np.float64)])
+    data = np.array([reference_denoise(data[:, i], raw_std[i]) for i in range(data.shape[1])]).T
+    data = ((data - mean) / std)[-(time_steps + step):]
+    x = np.array([data[i:i + time_steps] for i in range(0, len(data) - time_steps, step)])
+    return np.transpose(x, (0, 2, 1)).reshape(len(x), data.shape[1], 10, 10)
+
+
+def reference_dataset(input_files, time_steps, step):
+    """
+    The original preprocessing.py, frozen: the input files concatenated in one DataFrame, per-row
+    euler conversion, whole-series denoising and per-window slicing. Returns (x, raw_std, mean, std)
+    """
+    df = pd.concat([pd.read_csv(f, compression='gzip', sep=',', low_memory=False) for f in input_files])
+    angles = np.array([reference_euler(row['qx'], row['qy'], row['qz'], row['qw']) for idx, row in df.iterrows()])
+    df['roll'], df['pitch'], df['yaw'] = angles[:, 0], angles[:, 1], angles[:, 2]
+    df = df[pp.FEATURES]
+    raw_std = df.std()
+    for f in pp.FEATURES:
+        df[f] = reference_denoise(np.array(df[f].values), raw_std[f])[:len(df)]
+    mean, std = df.mean(), df.std()
+    df = (df - mean) / std
+    x = np.array([df.iloc[i:(i + time_steps)].values for i in range(0, len(df) - time_steps, step)])
+    x = np.nan_to_num(x, copy=True, nan=0.0, posinf=None, neginf=None)
+    x = np.transpose(x, (0, 2, 1)).reshape(x.shape[0], len(pp.FEATURES), 10, 10)
+    return x, raw_std.values, mean.values, std.values
+
+
+def check_baseline(telemetry_path, rows, args):
+    """
+    Runs the full mode of preprocessing.py (extract, join, denoise, write) on the telemetry split
+    in two input files and returns the max abs diff of its dataset and statistics vs reference_dataset
+    """
+    time_steps = args.interval * args.time_steps
+    with tempfile.TemporaryDirectory() as work_dir:
+        df = pd.read_csv(telemetry_path, compression='gzip')
+        half = len(df) // 2
+        input_files = [os.path.join(work_dir, 'telemetry_%d.csv.gz' % i) for i in range(2)]
+        df.iloc[:half].to_csv(input_files[0], index=False, compression='gzip')
+        df.iloc[half:].to_csv(input_files[1], index=False, compression='gzip')
+
+        extracted = [pp.extract_features(f, work_dir) for f in input_files]
+        raw_std = pp.merge_stats(extracted).std
+        series = pp.join_features([p for p, _ in extracted], os.path.join(work_dir, 'telemetry.features'))
+        denoised = pp.denoise_features([series], raw_std, num_workers=1, block_size=args.denoise_block_size)
+        stats = pp.merge_stats(denoised)
+        shards = pp.write_dataset([p for p, _ in denoised], stats.mean, stats.std, time_steps, args.step, work_dir,
+                                  shard_bytes=int(args.shard_size_mb * 1024 * 1024))
+        x = np.concatenate([np.load(os.path.join(work_dir, s['file'])) for s in shards])
+
+        ref_x, ref_raw_std, ref_mean, ref_std = reference_dataset(input_files, time_steps, args.step)
+    if x.shape != ref_x.shape:
+        raise Exception("baseline dataset: %s windows, the original preprocessing %s" % (x.shape, ref_x.shape))
+    return {
+        'baseline_dataset': float(np.abs(x - ref_x).max()),
+        'baseline_statistics': float(max(np.abs(raw_std / ref_raw_std - 1).max(), np.abs((stats.mean - ref_mean) / ref_std).max(),
+                                         np.abs(stats.std / ref_std - 1).max()))
+    }
+
+
+def check_parity(features, denoised, raw_std, stats, args):
+    """
+    Checks the shared signal processing module: its results against the original
+    implementations, and its copies in the detector and in the simulator against this one
+    (plus the simulator copies of EDGE_SHARED_MODULES against the detector ones).
+    Returns {check: max abs diff}; the copies are skipped when the deploy code isn't available
+    """
+    time_steps = args.interval * args.time_steps
+    n = min(len(features), 5000)
+    normalized = (denoised[:n] - stats.mean.astype(np.float32)) / stats.std.astype(np.float32)
+
+    # the streaming windowing of write_dataset vs the original per-window slicing
+    ref = np.array([normalized[i:i + time_steps] for i in range(0, n - time_steps, args.step)])
+    ref = np.transpose(np.nan_to_num(ref), (0, 2, 1)).reshape(len(ref), normalized.shape[1], 10, 10)
+    diffs = {'windowing': float(np.abs(windowing(normalized, time_steps, args.step) - ref).max())}
+
+    rng = np.random.RandomState(0)
+    q = rng.normal(size=(n, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    vectorized = np.stack(pp.euler_from_quaternion(q[:, 0], q[:, 1], q[:, 2], q[:, 3]), axis=1)
+    diffs['euler'] = float(np.abs(np.array([reference_euler(*row) for row in q]) - vectorized).max())
+
+    # the fused float32 preprocessor used by the detector and the simulator vs the float64 path
+    buffer = np.hstack([q[:500], rng.uniform([0, 0, 0], [10, 10, 300], size=(500, 3))])
+    fused = sp.WindowPreprocessor(raw_std, stats.mean, stats.std, time_steps, args.step, num_samples=len(buffer))
+    diffs['window_preprocessor'] = float(np.abs(
+        fused(buffer) - reference_window(buffer, raw_std, stats.mean, stats.std, time_steps, args.step)).max())
+
+    # the deployed copies must be identical to this one, and the simulator copies to the detector modules
+    copies = [(sp.__file__, os.path.join(p, 'signal_processing.py'))
+              for p in (args.edge_path, args.simulator_path) if p is not None]
+    if args.edge_path is not None and args.simulator_path is not None:
+        copies += [(os.path.join(args.edge_path, m), os.path.join(args.simulator_path, m)) for m in EDGE_SHARED_MODULES]
+    if not all(os.path.isdir(os.path.dirname(c)) for _, c in copies):
+        print("deploy code not found: skipping the library copies check")
+        return diffs
+    different = [c for source, c in copies
+                 if not (os.path.exists(source) and os.path.exists(c) and filecmp.cmp(source, c, shallow=False))]
+    for c in different:
+        print("library copy differs: %s" % c)
+    diffs['library_copies'] = float(len(different))
+    return diffs
+
+
+def compare(report, baseline, max_slowdown):
+    """ Returns the list of regressions against a baseline report """
+    regressions = []
+    previous = {s['stage']: s for s in baseline['stages']}
+    for stage in report['stages']:
+        ref = previous.get(stage['stage'])
+        if ref is None:
+            continue
+        slowdown = ref['rows_per_second'] / stage['rows_per_second']
+        if slowdown > max_slowdown:
+            regressions.append("%s: %.2fx slower (%.0f -> %.0f rows/s)" % (
+                stage['stage'], slowdown, ref['rows_per_second'], stage['rows_per_second']))
+    for check, diff in report['parity'].items():
+        if diff > PARITY_TOLERANCE[check]:
+            regressions.append("parity: %s differs by %.2e" % (check, diff))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000, help='Synthetic telemetry samples')
+    parser.add_argument('--interval', type=int, default=5)
+    parser.add_argument('--time-steps', type=int, default=20)
+    parser.add_argument('--step', type=int, default=10)
+    parser.add_argument('--denoise-block-size', type=int, default=1048576)
+    parser.add_argument('--shard-size-mb', type=float, default=5.0)
+    parser.add_argument('--output-format', type=str, default='npy', choices=sorted(pp.SHARD_WRITERS.keys()))
+    parser.add_argument('--output-dir', type=str, default='benchmark', help='Where the report and the .prof files are saved')
+    parser.add_argument('--edge-path', type=str, default=DEFAULT_EDGE_PATH, help='Detector inference code')
+    parser.add_argument('--simulator-path', type=str, default=DEFAULT_SIMULATOR_PATH, help='Fleet simulator code')
+    parser.add_argument('--baseline-rows', type=int, default=20000, help='Samples of the check against the original preprocessing')
+    parser.add_argument('--baseline', type=str, default=None, help='Previous benchmark.json to compare with')
+    parser.add_argument('--max-slowdown', type=float, default=1.25)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage, the fastest is reported')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    runner = StageRunner(args.output_dir, args.repeat)
+    with tempfile.TemporaryDirectory() as data_dir:
+        telemetry_path = os.path.join(data_dir, 'telemetry.csv.gz')
+        start_time = time.time()
+        make_telemetry(telemetry_path, args.rows)
+        print("synthetic telemetry: rows=%d; elapsed_time=%.3fs" % (args.rows, time.time() - start_time))
+        features, denoised, raw_std, stats = run_stages(runner, telemetry_path, args.rows, args)
+        # the original per-row preprocessing is slow: it runs on the first --baseline-rows only
+        baseline_path = os.path.join(data_dir, 'baseline.csv.gz')
+        make_telemetry(baseline_path, min(args.rows, args.baseline_rows))
+        baseline = check_baseline(baseline_path, min(args.rows, args.baseline_rows), args)
+
+    parity = check_parity(features, denoised, raw_std, stats, args)
+    parity.update(baseline)
+    for check, diff in parity.items():
+        print("parity %-20s max abs diff: %.2e" % (check, diff))
+
+    report = {'rows': args.rows, 'stages': runner.results, 'parity': parity}
+    report_path = os.path.join(args.output_dir, 'benchmark.json')
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("report saved to %s (profiles: <stage>.prof)" % report_path)
+
+    if args.baseline is not None:
+        regressions = compare(report, baseline, args.max_slowdown)
+        for r in regressions:
+            print("REGRESSION %s" % r)
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -1,132 +1,633 @@
 import sys
 import subprocess
 
-# we need a special package for cleaning our data, lets pip install it first
-subprocess.check_call([sys.executable, "-m", "pip", "install", "pywavelets==1.1.1"])
+try:
+    import pywt
+except ImportError:
+    # we need a special package for cleaning our data, lets pip install it first
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "pywavelets==1.1.1"])
+    import pywt
 
 import argparse
 import os
 import pandas as pd
 import numpy as np
-import pywt
-import math
 import glob
-from datetime import datetime
+import time
+import multiprocessing
+import json
+import hashlib
+import shutil
+from functools import partial
 
-def create_dataset(X, time_steps=1, step=1):
+# the signal processing module shared with the edge and the arrow shards format shared
+# with training are next to this file, or mounted by the pipeline in /opt/ml/processing/lib
+sys.path.append('/opt/ml/processing/lib')
+from arrow_format import ARROW_METADATA_KEY, import_pyarrow
+from signal_processing import (DENOISE_TOLERANCE, count_windows, euler_from_quaternion, sliding_windows,
+                               to_model_input, wavelet_denoise, wavelet_denoise_blocks)
+
+# columns read from the telemetry exports and their compact dtypes
+COLUMNS = ['eventTime', 'qx', 'qy', 'qz', 'qw', 'wind_speed_rps', 'rps', 'voltage']
+DTYPES = {c: np.float32 for c in COLUMNS[1:]}
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f+00:00'
+FEATURES = ['roll', 'pitch', 'yaw', 'wind_speed_rps', 'rps', 'voltage']
+
+# full runs everything on one instance; the sharded pipeline runs
+# partial-stats -> denoise -> merge-stats -> transform as separate steps
+MODE_FULL = 'full'
+MODE_PARTIAL_STATS = 'partial-stats'
+MODE_DENOISE = 'denoise'
+MODE_MERGE_STATS = 'merge-stats'
+MODE_TRANSFORM = 'transform'
+MODES = (MODE_FULL, MODE_PARTIAL_STATS, MODE_DENOISE, MODE_MERGE_STATS, MODE_TRANSFORM)
+
+# part of the cache keys: change it when the first pass output changes
+CACHE_VERSION = 'features-v1:' + ','.join(FEATURES)
+
+
+def read_telemetry(path, chunksize=250000):
+    """
+    Reads a gzipped telemetry export in chunks, so only `chunksize` raw rows are parsed at a time.
+    Yields a DataFrame of the selected features (float32) for each chunk
+    """
+    for chunk in pd.read_csv(path, compression='gzip', sep=',', usecols=COLUMNS, dtype=DTYPES, chunksize=chunksize):
+        event_time = pd.to_datetime(chunk['eventTime'], format=DATE_FORMAT)
+        roll, pitch, yaw = euler_from_quaternion(chunk['qx'].values, chunk['qy'].values, chunk['qz'].values, chunk['qw'].values)
+        yield pd.DataFrame({
+            'roll': roll, 'pitch': pitch, 'yaw': yaw,
+            'wind_speed_rps': chunk['wind_speed_rps'].values,
+            'rps': chunk['rps'].values,
+            'voltage': chunk['voltage'].values
+        }, index=pd.DatetimeIndex(event_time, name='eventTime'))
+
+class RunningStats(object):
+    """
+    Streaming per-feature count, mean and variance (Welford), so the statistics
+    can be computed chunk by chunk without keeping the dataset in memory.
+    Partial results from chunks, files or processing instances are combined with
+    merge() (Chan et al. parallel algorithm). NaNs are skipped, like pandas does.
+    """
+    def __init__(self, n_features):
+        self.count = np.zeros(n_features, dtype=np.int64)
+        self.mean = np.zeros(n_features, dtype=np.float64)
+        self.m2 = np.zeros(n_features, dtype=np.float64)
+
+    def update(self, x):
+        """ Adds a chunk of samples (rows x features) """
+        x = np.asarray(x, dtype=np.float64)
+        valid = ~np.isnan(x)
+        count = valid.sum(axis=0)
+        total = np.where(valid, x, 0.0).sum(axis=0)
+        mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+        m2 = np.where(valid, x - mean, 0.0)
+        m2 = (m2 * m2).sum(axis=0)
+        self.__combine__(count, mean, m2)
+        return self
+
+    @classmethod
+    def concat(cls, stats):
+        """ Joins the statistics of disjoint sets of features """
+        total = cls(0)
+        total.count = np.concatenate([s.count for s in stats])
+        total.mean = np.concatenate([s.mean for s in stats])
+        total.m2 = np.concatenate([s.m2 for s in stats])
+        return total
+
+    def merge(self, other):
+        """ Adds the partial statistics of another accumulator """
+        self.__combine__(other.count, other.mean, other.m2)
+        return self
+
+    def __combine__(self, count, mean, m2):
+        n = self.count + count
+        delta = mean - self.mean
+        ratio = np.divide(count, n, out=np.zeros(len(n)), where=n > 0)
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + m2 + delta * delta * self.count * ratio
+        self.count = n
+
+    @property
+    def var(self):
+        """ Sample variance (ddof=1), the same as DataFrame.var() """
+        return np.divide(self.m2, self.count - 1, out=np.full(len(self.m2), np.nan), where=self.count > 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def to_dict(self):
+        return {'count': self.count.tolist(), 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(len(d['count']))
+        stats.count = np.array(d['count'], dtype=np.int64)
+        stats.mean = np.array(d['mean'], dtype=np.float64)
+        stats.m2 = np.array(d['m2'], dtype=np.float64)
+        return stats
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+def map_files(fn, items, num_workers=None):
     """
-    Encode the timeseries dataset into a
-    multidimentional tensor in the format: num_features x step x step.
-    It uses a time window approach to slide on 'step' right in the timeseries.    
+    Applies fn to each item in parallel, one file per worker process.
+    Returns the results in the same order of the items
     """
-    Xs = []
-    for i in range(0, len(X) - time_steps, step):
-        v = X.iloc[i:(i + time_steps)].values
-        Xs.append(v)
-    return np.array(Xs)
+    num_workers = min(num_workers or multiprocessing.cpu_count(), max(1, len(items)))
+    if num_workers == 1:
+        return [fn(i) for i in items]
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.map(fn, items)
 
-def euler_from_quaternion(x, y, z, w):
+def feature_rows(path):
+    """ Number of rows of an intermediate float32 features file, from its size """
+    return os.path.getsize(path) // (np.dtype(np.float32).itemsize * len(FEATURES))
+
+def open_features(path, mode='r', rows=None):
+    """ Memory maps an intermediate (rows x features) float32 file """
+    rows = feature_rows(path) if rows is None else rows
+    if rows == 0:
+        return np.empty((0, len(FEATURES)), dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode=mode, shape=(rows, len(FEATURES)))
+
+class FeatureCache(object):
     """
-    Convert a quaternion into euler angles (roll, pitch, yaw)
-    roll is rotation around x in radians (counterclockwise)
-    pitch is rotation around y in radians (counterclockwise)
-    yaw is rotation around z in radians (counterclockwise)
+    Cache of the first pass results of each input file (euler features + raw statistics),
+    keyed by the content hash of the file, so a new run only converts the new files.
+    The cache is a local directory or an s3:// prefix: <uri>/<sha256>/{features,raw_stats.json}
     """
-    t0 = +2.0 * (w * x + y * z)
-    t1 = +1.0 - 2.0 * (x * x + y * y)
-    roll_x = math.atan2(t0, t1)
+    def __init__(self, uri):
+        self.uri = uri.rstrip('/')
+        self.s3 = None
+
+    @staticmethod
+    def digest(path, block_size=1 << 20):
+        h = hashlib.sha256(CACHE_VERSION.encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        return h.hexdigest()
 
-    t2 = +2.0 * (w * y - z * x)
-    t2 = +1.0 if t2 > +1.0 else t2
-    t2 = -1.0 if t2 < -1.0 else t2
-    pitch_y = math.asin(t2)
+    def __s3_location__(self, key, name):
+        if self.s3 is None:
+            import boto3
+            self.s3 = boto3.client('s3')
+        bucket, _, prefix = self.uri[len('s3://'):].partition('/')
+        return bucket, '/'.join(p for p in (prefix, key, name) if p)
 
-    t3 = +2.0 * (w * z + x * y)
-    t4 = +1.0 - 2.0 * (y * y + z * z)
-    yaw_z = math.atan2(t3, t4)
+    def get(self, key, name, path):
+        """ Copies a cached entry to path. Returns False when it is not cached """
+        if self.uri.startswith('s3://'):
+            import botocore
+            bucket, s3_key = self.__s3_location__(key, name)
+            try:
+                self.s3.download_file(bucket, s3_key, path)
+                return True
+            except botocore.exceptions.ClientError:
+                if os.path.exists(path):
+                    os.remove(path)
+                return False
+        cached = os.path.join(self.uri, key, name)
+        if not os.path.exists(cached):
+            return False
+        shutil.copyfile(cached, path)
+        return True
 
-    return roll_x, pitch_y, yaw_z # in radians
+    def put(self, key, name, path):
+        """ Stores a local file in the cache """
+        if self.uri.startswith('s3://'):
+            bucket, s3_key = self.__s3_location__(key, name)
+            self.s3.upload_file(path, bucket, s3_key)
+            return
+        os.makedirs(os.path.join(self.uri, key), exist_ok=True)
+        shutil.copyfile(path, os.path.join(self.uri, key, name))
+
+def extract_features(path, work_dir, chunksize=250000, cache_uri=None):
+    """
+    First pass: reads a telemetry export in chunks, converts the quaternions to euler angles
+    and appends the features to a local float32 file, accumulating the raw statistics.
+    With a cache_uri, files that were already converted are copied from the cache.
+    Returns (features path, RunningStats)
+    """
+    start_time = time.time()
+    out_path = os.path.join(work_dir, os.path.basename(path) + '.features')
+    stats_path = out_path + '.json'
+    cache = FeatureCache(cache_uri) if cache_uri else None
+    if cache is not None:
+        key = cache.digest(path)
+        # the statistics are stored last, so they mark a complete entry
+        if cache.get(key, 'raw_stats.json', stats_path) and cache.get(key, 'features', out_path):
+            stats = RunningStats.load(stats_path)
+            os.remove(stats_path)
+            print("features %s: cached %s; rows=%d; elapsed_time=%.3fs" % (
+                os.path.basename(path), key[:12], feature_rows(out_path), time.time() - start_time))
+            return out_path, stats
 
-def wavelet_denoise(data, wavelet, noise_sigma):
-    '''Filter accelerometer data using wavelet denoising
+    stats = RunningStats(len(FEATURES))
+    rows = 0
+    with open(out_path, 'wb') as f:
+        for chunk in read_telemetry(path, chunksize):
+            values = np.ascontiguousarray(chunk[FEATURES].values, dtype=np.float32)
+            stats.update(values)
+            f.write(values.tobytes())
+            rows += len(values)
 
-    Modification of F. Blanco-Silva's code at: https://goo.gl/gOQwy5
-    '''
-    
-    wavelet = pywt.Wavelet(wavelet)
-    levels  = min(5, (np.floor(np.log2(data.shape[0]))).astype(int))
-    
-    # Francisco's code used wavedec2 for image data
-    wavelet_coeffs = pywt.wavedec(data, wavelet, level=levels)
-    threshold = noise_sigma*np.sqrt(2*np.log2(data.size))
+    if cache is not None:
+        stats.save(stats_path)
+        cache.put(key, 'features', out_path)
+        cache.put(key, 'raw_stats.json', stats_path)
+        os.remove(stats_path)
+    print("features %s: rows=%d; elapsed_time=%.3fs" % (os.path.basename(path), rows, time.time() - start_time))
+    return out_path, stats
 
-    new_wavelet_coeffs = map(lambda x: pywt.threshold(x, threshold, mode='soft'), wavelet_coeffs)
+def join_features(paths, out_path):
+    """
+    Joins the features files, in order, into one series (the files are raw float32 rows).
+    The denoising and the windowing then run over the whole series, as the original
+    preprocessing of the concatenated dataset did, and windows span the file boundaries
+    """
+    with open(out_path, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 24)
+    return out_path
+
+def denoise_column(task, raw_std, block_size=1048576):
+    """
+    Second pass: denoises one feature of a features file, block by block, into
+    its preallocated .denoised file. Returns the RunningStats of that feature
+    """
+    path, out_path, i = task
+    start_time = time.time()
+    data = open_features(path)
+    denoised = open_features(out_path, mode='r+')
+    wavelet_denoise_blocks(data[:, i], 'db6', raw_std[i], block_size, out=denoised[:, i])
+    stats = RunningStats(1)
+    for b in range(0, len(denoised), max(1, block_size)):
+        stats.update(denoised[b:b + max(1, block_size), i:i + 1])
+    denoised.flush()
+    del denoised
+    print("denoised %s[%s]: rows=%d; elapsed_time=%.3fs" % (os.path.basename(path), FEATURES[i], len(data), time.time() - start_time))
+    return stats
+
+def denoise_features(paths, raw_std, work_dir=None, num_workers=None, block_size=1048576):
+    """
+    Second pass: denoises the features of each input file and accumulates the statistics
+    used for the normalization. The (file, feature) pairs run in parallel, each worker
+    writing its own column of the output file. Returns a list of (denoised path, RunningStats)
+    """
+    outputs = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        out_path = os.path.join(work_dir or os.path.dirname(path), name + '.denoised')
+        with open(out_path, 'wb') as f:
+            f.truncate(os.path.getsize(path))
+        outputs.append(out_path)
+
+    tasks = [(p, o, i) for p, o in zip(paths, outputs) if feature_rows(p) > 0 for i in range(len(FEATURES))]
+    columns = iter(map_files(partial(denoise_column, raw_std=raw_std, block_size=block_size), tasks, num_workers))
+    results = []
+    for path, out_path in zip(paths, outputs):
+        if feature_rows(path) > 0:
+            stats = RunningStats.concat([next(columns) for _ in FEATURES])
+        else:
+            stats = RunningStats(len(FEATURES))
+        results.append((out_path, stats))
+    return results
+
+def merge_stats(results):
+    """ Merges the RunningStats of a list of (path, RunningStats) """
+    total = RunningStats(len(FEATURES))
+    for _, stats in results:
+        total.merge(stats)
+    return total
+
+def load_partial_stats(path, pattern):
+    """ Merges the partial statistics (json) written by the processing instances """
+    files = sorted(glob.glob(os.path.join(path, pattern)))
+    if len(files) == 0:
+        raise Exception("No partial statistics '%s' found in %s" % (pattern, path))
+    return merge_stats([(f, RunningStats.load(f)) for f in files])
+
+def get_host():
+    """ Name of this processing instance and of all the instances of the job """
+    try:
+        with open('/opt/ml/config/resourceconfig.json', 'r') as f:
+            config = json.load(f)
+        return config['current_host'], config['hosts']
+    except (IOError, KeyError, ValueError):
+        return 'algo-1', ['algo-1']
+
+def get_shard_sizes(total, sample_bytes, shard_bytes=0, num_splits=1):
+    """
+    Number of windows of each shard: as many as fit in `shard_bytes`,
+    or `num_splits` shards like np.array_split when shard_bytes is 0
+    """
+    if shard_bytes > 0:
+        per_shard = max(1, int(shard_bytes // sample_bytes))
+        return [min(per_shard, total - i) for i in range(0, total, per_shard)]
+    return [total // num_splits + (1 if i < total % num_splits else 0) for i in range(num_splits)]
 
-    return pywt.waverec(list(new_wavelet_coeffs), wavelet)
+class NpyShardWriter(object):
+    """ Writes the windows straight into memory mapped .npy shards """
+    extension = '.npy'
+
+    def __init__(self, paths, sizes, sample_shape, metadata=None):
+        self.shards = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(size,) + tuple(sample_shape))
+                       for path, size in zip(paths, sizes)]
+
+    def write(self, shard, offset, x):
+        self.shards[shard][offset:offset + len(x)] = x
+
+    def close(self):
+        for s in self.shards:
+            s.flush()
+
+class ArrowShardWriter(object):
+    """
+    Writes the windows into compressed Arrow IPC files, one record batch per block of windows.
+    Each window is a row of the fixed size list column 'x' (float32) and the sample shape,
+    window parameters and statistics are kept in the schema metadata (ARROW_METADATA_KEY)
+    """
+    extension = '.arrow'
+
+    def __init__(self, paths, sizes, sample_shape, metadata=None, compression='zstd'):
+        self.pa = import_pyarrow()
+        self.paths = paths
+        self.sample_size = int(np.prod(sample_shape))
+        metadata = dict(metadata or {}, sample_shape=list(sample_shape))
+        self.schema = self.pa.schema([self.pa.field('x', self.pa.list_(self.pa.float32(), self.sample_size))],
+                                     metadata={ARROW_METADATA_KEY: json.dumps(metadata)})
+        self.options = self.pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+        self.current, self.writer = -1, None
+
+    def __open__(self, shard):
+        # the shards are filled in order, so only one file is open at a time
+        while self.current < shard:
+            if self.writer is not None:
+                self.writer.close()
+            self.current += 1
+            self.writer = self.pa.ipc.new_file(self.paths[self.current], self.schema, options=self.options)
+
+    def write(self, shard, offset, x):
+        self.__open__(shard)
+        values = self.pa.array(np.ascontiguousarray(x, dtype=np.float32).reshape(-1))
+        column = self.pa.FixedSizeListArray.from_arrays(values, self.sample_size)
+        self.writer.write_batch(self.pa.record_batch([column], schema=self.schema))
+
+    def close(self):
+        self.__open__(len(self.paths) - 1)
+        if self.writer is not None:
+            self.writer.close()
+
+SHARD_WRITERS = {'npy': NpyShardWriter, 'arrow': ArrowShardWriter}
+
+def write_dataset(paths, mean, std, time_steps, step, output_path, prefix='wind_turbine',
+                  shard_bytes=0, num_splits=1, output_format='npy', metadata=None, block_size=10000, **kwargs):
+    """
+    Normalizes the denoised features and streams the windows (n, features, 10, 10) in float32
+    straight into shards (see get_shard_sizes) of the output format: npy or arrow.
+    Windows don't cross the given files, so the files of one series are joined first (see
+    join_features). Only `block_size` windows are in memory at a time.
+    Returns the manifest entries of the shards: file name and number of samples
+    """
+    n_cols = len(FEATURES)
+    side = int(round(np.sqrt(time_steps)))
+    sample_bytes = n_cols * time_steps * np.dtype(np.float32).itemsize
+    total = sum(count_windows(feature_rows(p), time_steps, step) for p in paths)
+    sizes = get_shard_sizes(total, sample_bytes, shard_bytes, num_splits)
+    writer_class = SHARD_WRITERS[output_format]
+    names = ['%s_%02d%s' % (prefix, i, writer_class.extension) for i in range(len(sizes))]
+    writer = writer_class([os.path.join(output_path, name) for name in names], sizes, (n_cols, side, side), metadata, **kwargs)
+    shard, offset = 0, 0
+    mean = np.asarray(mean, dtype=np.float32)
+    std = np.asarray(std, dtype=np.float32)
+    for path in paths:
+        n_windows = count_windows(feature_rows(path), time_steps, step)
+        if n_windows == 0:
+            continue
+        windows = sliding_windows(open_features(path), time_steps, step)
+        for b in range(0, n_windows, block_size):
+            x = (windows[b:b + block_size] - mean) / std
+            x = to_model_input(np.nan_to_num(x, copy=False, nan=0.0))
+            i = 0
+            while i < len(x):
+                while offset == sizes[shard]:
+                    shard, offset = shard + 1, 0
+                n = min(len(x) - i, sizes[shard] - offset)
+                writer.write(shard, offset, x[i:i + n])
+                offset, i = offset + n, i + n
+    writer.close()
+    return [{'file': name, 'samples': size} for name, size in zip(names, sizes)]
+
+def get_dataset_metadata(raw_std, mean, std, time_steps, step):
+    """ Window parameters and statistics kept with the arrow shards """
+    return {
+        'features': FEATURES,
+        'time_steps': time_steps,
+        'step': step,
+        'raw_std': np.asarray(raw_std).tolist(),
+        'mean': np.asarray(mean).tolist(),
+        'std': np.asarray(std).tolist()
+    }
+
+def save_manifest(path, shards, time_steps, output_format='npy'):
+    """ Exports the list of shards with their number of samples """
+    side = int(round(np.sqrt(time_steps)))
+    manifest = {
+        'format': output_format,
+        'dtype': 'float32',
+        'sample_shape': [len(FEATURES), side, side],
+        'samples': int(sum(s['samples'] for s in shards)),
+        'shards': shards
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def save_statistics(path, raw_std, mean, std):
+    """ Exports the dataset statistics used by training and inference """
+    np.save(os.path.join(path, 'raw_std.npy'), raw_std)
+    np.save(os.path.join(path, 'mean.npy'), mean)
+    np.save(os.path.join(path, 'std.npy'), std)
+
+def run_benchmark(num_rows, num_reference_rows=20000, seed=42):
+    """
+    Measures the quaternion to euler conversion on a synthetic dataset
+    and compares it with the previous per-row (iterrows) conversion
+    """
+    rng = np.random.RandomState(seed)
+    q = rng.normal(size=(num_rows, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    df = pd.DataFrame(q, columns=['qx', 'qy', 'qz', 'qw'])
+
+    start_time = time.time()
+    roll, pitch, yaw = euler_from_quaternion(df['qx'].values, df['qy'].values, df['qz'].values, df['qw'].values)
+    elapsed_time = time.time() - start_time
+    print("euler (vectorized): rows=%d; elapsed_time=%.3fs; rows_per_second=%.0f" % (num_rows, elapsed_time, num_rows / elapsed_time))
+
+    # the per-row conversion is too slow for the whole dataset, so it runs on a sample
+    sample = df.iloc[:num_reference_rows]
+    start_time = time.time()
+    ref = [euler_from_quaternion(row['qx'], row['qy'], row['qz'], row['qw']) for idx, row in sample.iterrows()]
+    elapsed_time = time.time() - start_time
+    print("euler (iterrows): rows=%d; elapsed_time=%.3fs; rows_per_second=%.0f" % (len(sample), elapsed_time, len(sample) / elapsed_time))
+
+    max_diff = np.abs(np.array(ref) - np.stack([roll, pitch, yaw], axis=1)[:len(sample)]).max()
+    print("max abs diff: %.2e" % max_diff)
+
+def run_denoise_benchmark(num_rows, block_size, seed=42):
+    """
+    Compares the block-wise denoising with the whole-series one on a synthetic random walk
+    """
+    rng = np.random.RandomState(seed)
+    data = np.cumsum(rng.normal(size=num_rows)) + rng.normal(scale=3.0, size=num_rows)
+    noise_sigma = data.std()
+
+    start_time = time.time()
+    reference = wavelet_denoise(data, 'db6', noise_sigma)[:num_rows]
+    print("denoise (whole series): rows=%d; elapsed_time=%.3fs" % (num_rows, time.time() - start_time))
+
+    start_time = time.time()
+    blocks = wavelet_denoise_blocks(data, 'db6', noise_sigma, block_size)
+    print("denoise (blocks of %d): rows=%d; elapsed_time=%.3fs" % (block_size, num_rows, time.time() - start_time))
+
+    max_diff = np.abs(blocks - reference).max()
+    tolerance = DENOISE_TOLERANCE * np.abs(data).max()
+    print("max abs diff: %.2e; tolerance: %.2e; %s" % (max_diff, tolerance, 'ok' if max_diff <= tolerance else 'FAILED'))
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default=MODE_FULL, choices=MODES,
+                        help='full: single instance; partial-stats, denoise, merge-stats, transform: sharded steps')
     parser.add_argument('--interval', type=int, default=5)
     parser.add_argument('--time-steps', type=int, default=20)
     parser.add_argument('--step', type=int, default=10)
-    parser.add_argument('--num-dataset-splits', type=int, default=25)
+    parser.add_argument('--num-dataset-splits', type=int, default=25, help='Number of training files, when --shard-size-mb is 0')
+    parser.add_argument('--shard-size-mb', type=float, default=5.0, help='Target size of each training file (float32)')
+    parser.add_argument('--num-workers', type=int, default=None, help='Processes used to process the input files. Default: number of cores')
+    parser.add_argument('--chunksize', type=int, default=250000, help='Rows parsed at a time from each input file')
+    parser.add_argument('--denoise-block-size', type=int, default=1048576, help='Samples denoised at a time. 0: the whole series')
+    parser.add_argument('--output-format', type=str, default='npy', choices=sorted(SHARD_WRITERS.keys()),
+                        help='npy: raw .npy files; arrow: compressed Arrow IPC files with the statistics as metadata')
+    parser.add_argument('--compression', type=str, default='zstd', choices=['zstd', 'lz4', 'none'], help='Compression of the arrow files')
+    parser.add_argument('--cache-uri', type=str, default=None, help='Directory or s3:// prefix caching the features of each input file')
+    parser.add_argument('--work-dir', type=str, default='/opt/ml/processing/work', help='Local directory for the intermediate features')
+    parser.add_argument('--benchmark', action='store_true', help='Run the benchmark on a synthetic dataset and exit')
+    parser.add_argument('--benchmark-rows', type=int, default=1000000)
     args, _ = parser.parse_known_args()
 
     print('Received arguments {}'.format(args))
 
+    if args.benchmark:
+        run_benchmark(args.benchmark_rows)
+        run_denoise_benchmark(args.benchmark_rows, args.denoise_block_size)
+        sys.exit(0)
+
     INTERVAL = args.interval # seconds
     TIME_STEPS = args.time_steps * INTERVAL # Xms -> seg: Xms * Y
     STEP = args.step
 
     # selected the features
-    features = ['roll', 'pitch', 'yaw', 'wind_speed_rps', 'rps', 'voltage']    
+    features = FEATURES
     input_data_base_path = '/opt/ml/processing/input'
+    features_path = '/opt/ml/processing/features'
+    raw_stats_path = '/opt/ml/processing/raw_stats'
+    denoised_path = '/opt/ml/processing/denoised'
+    denoised_stats_path = '/opt/ml/processing/denoised_stats'
     stats_output_base_path = '/opt/ml/processing/statistics'
     dataset_output_base_path = '/opt/ml/processing/train'
+    manifest_output_base_path = '/opt/ml/processing/manifest'
+
+    shard_bytes = int(args.shard_size_mb * 1024 * 1024)
+    output_options = {'output_format': args.output_format}
+    if args.output_format == 'arrow':
+        output_options['compression'] = args.compression
+    if args.mode in (MODE_FULL, MODE_TRANSFORM):
+        os.makedirs(manifest_output_base_path, exist_ok=True)
+
+    # in the sharded modes each instance only sees its own part of the inputs (ShardedByS3Key)
+    host, hosts = get_host()
+    start_time = time.time()
+
+    if args.mode == MODE_FULL:
+        work_dir = args.work_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        # first pass: convert quat to euler, chunk by chunk and file by file (in parallel)
+        input_files = sorted(glob.glob(os.path.join(input_data_base_path, '*.gz')))
+        extracted = map_files(partial(extract_features, work_dir=work_dir, chunksize=args.chunksize, cache_uri=args.cache_uri), input_files, args.num_workers)
+        # get the std for denoising
+        raw_std = merge_stats(extracted).std
+        # one series of all the input files (sorted by name), like the original concatenated dataset
+        series = join_features([p for p, _ in extracted], os.path.join(work_dir, 'telemetry.features'))
+        for p, _ in extracted:
+            os.remove(p)
+
+        # second pass: denoise and get the statistics for the normalization
+        denoised = denoise_features([series], raw_std, num_workers=args.num_workers, block_size=args.denoise_block_size)
+        training_stats = merge_stats(denoised)
+
+        # export the dataset statistics
+        save_statistics(stats_output_base_path, raw_std, training_stats.mean, training_stats.std)
+
+        # normalize & format the dataset
+        ## We need to split the array in chunks of at most --shard-size-mb
+        paths = [p for p, _ in denoised]
+        metadata = get_dataset_metadata(raw_std, training_stats.mean, training_stats.std, TIME_STEPS, STEP)
+        shards = write_dataset(paths, training_stats.mean, training_stats.std, TIME_STEPS, STEP, dataset_output_base_path,
+                               shard_bytes=shard_bytes, num_splits=args.num_dataset_splits, metadata=metadata, **output_options)
+        save_manifest(os.path.join(manifest_output_base_path, 'manifest.json'), shards, TIME_STEPS, args.output_format)
+
+    elif args.mode == MODE_PARTIAL_STATS:
+        os.makedirs(features_path, exist_ok=True)
+        os.makedirs(raw_stats_path, exist_ok=True)
+        # convert quat to euler for this shard and export the features + the partial raw statistics
+        input_files = sorted(glob.glob(os.path.join(input_data_base_path, '*.gz')))
+        extracted = map_files(partial(extract_features, work_dir=features_path, chunksize=args.chunksize, cache_uri=args.cache_uri), input_files, args.num_workers)
+        merge_stats(extracted).save(os.path.join(raw_stats_path, 'raw_%s.json' % host))
+        paths = [p for p, _ in extracted]
+
+    elif args.mode == MODE_DENOISE:
+        os.makedirs(denoised_path, exist_ok=True)
+        os.makedirs(denoised_stats_path, exist_ok=True)
+        # merge the raw statistics of all the shards, then denoise this shard
+        raw_std = load_partial_stats(raw_stats_path, 'raw_*.json').std
+        # the files of this instance are one series; windows don't span two instances
+        os.makedirs(args.work_dir, exist_ok=True)
+        feature_files = sorted(glob.glob(os.path.join(features_path, '*.features')))
+        series = join_features(feature_files, os.path.join(args.work_dir, 'telemetry_%s.features' % host))
+        denoised = denoise_features([series], raw_std, denoised_path, args.num_workers, args.denoise_block_size)
+        merge_stats(denoised).save(os.path.join(denoised_stats_path, 'denoised_%s.json' % host))
+        paths = [p for p, _ in denoised]
+
+    elif args.mode == MODE_MERGE_STATS:
+        # lightweight step: the global statistics from the partial ones
+        raw_std = load_partial_stats(raw_stats_path, 'raw_*.json').std
+        training_stats = load_partial_stats(denoised_stats_path, 'denoised_*.json')
+        save_statistics(stats_output_base_path, raw_std, training_stats.mean, training_stats.std)
+        paths = []
+
+    elif args.mode == MODE_TRANSFORM:
+        # normalize & format this shard with the global statistics
+        raw_std = np.load(os.path.join(stats_output_base_path, 'raw_std.npy'))
+        training_mean = np.load(os.path.join(stats_output_base_path, 'mean.npy'))
+        training_std = np.load(os.path.join(stats_output_base_path, 'std.npy'))
+        paths = sorted(glob.glob(os.path.join(denoised_path, '*.denoised')))
+        num_splits = max(1, -(-args.num_dataset_splits // len(hosts)))
+        metadata = get_dataset_metadata(raw_std, training_mean, training_std, TIME_STEPS, STEP)
+        shards = write_dataset(paths, training_mean, training_std, TIME_STEPS, STEP, dataset_output_base_path,
+                               prefix='wind_turbine_%s' % host, shard_bytes=shard_bytes, num_splits=num_splits,
+                               metadata=metadata, **output_options)
+        save_manifest(os.path.join(manifest_output_base_path, 'manifest_%s.json' % host), shards, TIME_STEPS, args.output_format)
 
-    # load the data file
-    parser = lambda date: datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f+00:00')
-    dfs = []
-    for f in glob.glob(os.path.join(input_data_base_path, '*.gz')):
-        dfs.append(pd.read_csv(f, compression='gzip', sep=',', low_memory=False, parse_dates=[ 'eventTime'], date_parser=parser))
-    df = pd.concat(dfs)
-    
-    print('now converting quat to euler...')
-    roll,pitch,yaw = [], [], []
-    for idx, row in df.iterrows():
-        r,p,y = euler_from_quaternion(row['qx'], row['qy'], row['qz'], row['qw'])
-        roll.append(r)
-        pitch.append(p)
-        yaw.append(y)
-    df['roll'] = roll
-    df['pitch'] = pitch
-    df['yaw'] = yaw
-
-    df = df[features] # keep only the selected features
-    
-    # get the std for denoising
-    raw_std = df.std()
-    # denoise
-    for f in features:
-        df[f] = wavelet_denoise(df[f].values, 'db6', raw_std[f])
-
-    # normalize
-    training_std = df.std()
-    training_mean = df.mean()
-    df = (df - training_mean) / training_std
-    
-    # export the dataset statistics
-    np.save(os.path.join(stats_output_base_path, 'raw_std.npy'), raw_std)
-    np.save(os.path.join(stats_output_base_path, 'mean.npy'), training_mean)
-    np.save(os.path.join(stats_output_base_path, 'std.npy'), training_std)
-    
-    # format the dataset
-    n_cols = len(df.columns)
-    X = create_dataset(df, TIME_STEPS, STEP)
-    X = np.nan_to_num(X, copy=True, nan=0.0, posinf=None, neginf=None)
-    X = np.transpose(X, (0, 2, 1)).reshape(X.shape[0], n_cols, 10, 10)
-
-    ## We need to split the array in chunks of at most 5MB    
-    for i,x in enumerate(np.array_split(X, args.num_dataset_splits)):
-        np.save(os.path.join(dataset_output_base_path, 'wind_turbine_%02d.npy' % i), x)
-    print("Number of training samples:", len(df))
+    print("mode=%s; host=%s; files=%d; elapsed_time=%.3fs" % (args.mode, host, len(paths), time.time() - start_time))
+    print("Number of training samples:", int(sum(feature_rows(p) for p in paths)))
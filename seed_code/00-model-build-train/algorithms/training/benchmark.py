@@ -0,0 +1,218 @@
+import argparse
+import copy
+import inspect
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+import wind_turbine as wt
+
+"""
+Throughput of the precision (--precision) and memory format (--channels_last) options
+of wind_turbine.py against float32, on the current device (cpu on the training instances).
+For each configuration it measures the training and the inference samples/s, the
+reconstruction MSE and how far the anomaly scores (per-window, per-feature mean abs error)
+move from the float32 ones, relative to the float32 scores.
+The fastest configuration whose scores stay within --max-score-diff keeps the anomaly
+thresholds valid.
+
+With --artifacts it compares instead the load time and the per-batch latency of the
+inference artifacts of --model-dir: pickled model.pth, TorchScript model.pt and
+model.onnx (with onnxruntime, when installed).
+
+    python3 benchmark.py --train ../../data/train --model-dir ./model --output-dir ./benchmark
+    python3 benchmark.py --model-dir ./model --artifacts
+"""
+
+# float16 autocast has few cpu kernels and is orders of magnitude slower there
+DEFAULT_PRECISIONS = [p for p in wt.supported_precisions() if p != 'float16' or wt.device == 'cuda']
+
+
+def load_samples(args):
+    """ Samples of --train (or synthetic ones) as a float32 tensor (n, features, 10, 10) """
+    if args.train is None:
+        rng = np.random.RandomState(42)
+        return torch.from_numpy(rng.normal(size=(args.samples, 6, 10, 10)).astype(np.float32))
+    dataset = wt.WindTurbineDataset(args.train)
+    indices = np.random.RandomState(42).permutation(len(dataset))[:args.samples]
+    return torch.stack([x for x, _ in dataset.__getitems__(np.sort(indices))])
+
+
+def load_pickled_model(path):
+    """ torch.load of the whole model; newer versions only load weights by default """
+    options = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    return torch.load(path, map_location=wt.device, **options)
+
+
+def load_model(args, x):
+    """ model.pth of --model-dir, or a float32 model briefly trained on the samples """
+    if args.model_dir is not None:
+        return load_pickled_model(os.path.join(args.model_dir, 'model.pth'))
+    model = wt.create_model(x.shape[1]).to(wt.device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.003)
+    train_steps(model, optimizer, x, args.batch_size, args.warmup_steps, 'float32', False)
+    return model
+
+
+def train_steps(model, optimizer, x, batch_size, steps, precision, channels_last):
+    """ Runs `steps` optimizer steps over the batches of x; returns the elapsed time """
+    criterion = nn.MSELoss()
+    model.train()
+    start_time = time.perf_counter()
+    for i in range(steps):
+        start = (i * batch_size) % max(1, len(x) - batch_size)
+        batch = wt.to_memory_format(x[start:start + batch_size].to(wt.device), channels_last)
+        optimizer.zero_grad()
+        with wt.autocast(precision):
+            output = model(batch)
+        loss = criterion(output.float(), batch)
+        loss.backward()
+        optimizer.step()
+    return time.perf_counter() - start_time
+
+
+def predict(model, x, batch_size):
+    """ predict_fn over the batches of x; returns the reconstruction and the elapsed time """
+    model.eval()
+    start_time = time.perf_counter()
+    p = torch.cat([wt.predict_fn(x[i:i + batch_size], model).cpu() for i in range(0, len(x), batch_size)])
+    return p, time.perf_counter() - start_time
+
+
+def run_config(model, x, precision, channels_last, args):
+    """ Benchmarks one configuration on copies of the model """
+    train_model = wt.to_memory_format(copy.deepcopy(model), channels_last)
+    optimizer = torch.optim.Adam(train_model.parameters(), lr=0.003)
+    # first steps outside of the timing: allocations and kernel selection
+    train_steps(train_model, optimizer, x, args.batch_size, 2, precision, channels_last)
+    train_time = train_steps(train_model, optimizer, x, args.batch_size, args.train_steps, precision, channels_last)
+
+    eval_model = wt.to_memory_format(copy.deepcopy(model), channels_last)
+    eval_model.precision, eval_model.channels_last = precision, channels_last
+    predict(eval_model, x[:args.batch_size], args.batch_size)
+    p, predict_time = predict(eval_model, x, args.batch_size)
+    return {
+        'precision': precision,
+        'channels_last': channels_last,
+        'train_samples_per_second': args.train_steps * args.batch_size / train_time,
+        'predict_samples_per_second': len(x) / predict_time,
+        'mse': float(((p - x) ** 2).mean()),
+        'scores': (p - x).abs().reshape(len(x), x.shape[1], -1).mean(dim=-1)
+    }
+
+
+def load_onnx(path):
+    """ onnxruntime session of an ONNX graph, wrapped as a function of a tensor """
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda x: torch.from_numpy(session.run(None, {'input0': x.numpy()})[0])
+
+
+def run_artifacts(args, x):
+    """ Load time (best of --repeat) and median per-batch latency of each artifact of --model-dir """
+    loaders = {
+        'model.pth': lambda: load_pickled_model(os.path.join(args.model_dir, 'model.pth')).eval(),
+        wt.TORCHSCRIPT_MODEL: lambda: torch.jit.load(os.path.join(args.model_dir, wt.TORCHSCRIPT_MODEL), map_location=wt.device),
+        wt.ONNX_MODEL: lambda: load_onnx(os.path.join(args.model_dir, wt.ONNX_MODEL))
+    }
+    reference = None
+    results = []
+    for name, loader in loaders.items():
+        if not os.path.exists(os.path.join(args.model_dir, name)):
+            print("%-12s not found" % name)
+            continue
+        try:
+            load_times = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                model = loader()
+                load_times.append(time.perf_counter() - start_time)
+        except ImportError as e:
+            print("%-12s skipped: %s" % (name, e))
+            continue
+
+        result = {'artifact': name, 'load_seconds': min(load_times), 'latency_ms': {}}
+        with torch.no_grad():
+            p = torch.cat([model(x[i:i + args.batch_size]) for i in range(0, len(x), args.batch_size)])
+            for batch_size in args.latency_batch_sizes:
+                batch = x[:batch_size]
+                model(batch)
+                latencies = []
+                for _ in range(args.repeat):
+                    start_time = time.perf_counter()
+                    model(batch)
+                    latencies.append(time.perf_counter() - start_time)
+                result['latency_ms'][batch_size] = float(np.median(latencies)) * 1000.0
+        reference = p if reference is None else reference
+        result['max_abs_diff'] = float((p - reference).abs().max())
+        results.append(result)
+        print("%-12s load_time=%.1fms; %s; max_abs_diff=%.2e" % (name, result['load_seconds'] * 1000.0,
+            '; '.join("batch_%d=%.2fms" % (b, t) for b, t in result['latency_ms'].items()), result['max_abs_diff']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', type=str, default=None, help='Training shards. Default: synthetic samples')
+    parser.add_argument('--model-dir', type=str, default=None, help='Trained model.pth. Default: a briefly trained model')
+    parser.add_argument('--samples', type=int, default=4096)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--train-steps', type=int, default=20)
+    parser.add_argument('--warmup-steps', type=int, default=50)
+    parser.add_argument('--precisions', type=str, nargs='+', default=DEFAULT_PRECISIONS, choices=wt.supported_precisions())
+    parser.add_argument('--max-score-diff', type=float, default=0.01, help='Max relative diff of the anomaly scores vs float32')
+    parser.add_argument('--output-dir', type=str, default='benchmark')
+    parser.add_argument('--artifacts', action='store_true', help='Benchmarks the inference artifacts of --model-dir')
+    parser.add_argument('--latency-batch-sizes', type=int, nargs='+', default=[1, 32, 256])
+    parser.add_argument('--repeat', type=int, default=10, help='Runs of each artifact measure')
+    args = parser.parse_args()
+
+    x = load_samples(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = os.path.join(args.output_dir, 'benchmark.json')
+    if args.artifacts:
+        if args.model_dir is None:
+            raise Exception("--artifacts requires --model-dir")
+        with open(report_path, 'w') as f:
+            json.dump({'device': wt.device, 'artifacts': run_artifacts(args, x)}, f, indent=2)
+        print("report saved to %s" % report_path)
+        sys.exit(0)
+
+    model = load_model(args, x)
+    print("device=%s; samples=%d; batch_size=%d" % (wt.device, len(x), args.batch_size))
+
+    results = []
+    # float32 first: the reference of the score diffs
+    precisions = ['float32'] + [p for p in args.precisions if p != 'float32']
+    for precision, channels_last in [(p, c) for p in precisions for c in (False, True)]:
+        try:
+            result = run_config(model, x, precision, channels_last, args)
+        except RuntimeError as e:
+            # i.e. no float16 kernels for some of the layers on this device
+            print("%-8s channels_last=%d: not supported (%s)" % (precision, channels_last, str(e).splitlines()[0]))
+            continue
+        results.append(result)
+
+    reference = results[0]
+    reference_scores = reference['scores']
+    for r in results:
+        scores = r.pop('scores')
+        r['score_diff'] = float(((scores - reference_scores).abs() / reference_scores.clamp(min=1e-6)).max())
+        r['mse_diff'] = abs(r['mse'] - reference['mse'])
+    for r in results:
+        print("%-8s channels_last=%d: train_samples_per_second=%.0f; predict_samples_per_second=%.0f; mse=%.6f; score_diff=%.2e" % (
+            r['precision'], r['channels_last'], r['train_samples_per_second'], r['predict_samples_per_second'], r['mse'], r['score_diff']))
+
+    valid = [r for r in results if r['score_diff'] <= args.max_score_diff]
+    best = max(valid, key=lambda r: r['train_samples_per_second'])
+    print("fastest configuration within score_diff=%.2e: --precision %s --channels_last %d" % (
+        args.max_score_diff, best['precision'], best['channels_last']))
+
+    with open(report_path, 'w') as f:
+        json.dump({'device': wt.device, 'samples': len(x), 'batch_size': args.batch_size,
+                   'results': results, 'best': best}, f, indent=2)
+    print("report saved to %s" % report_path)
@@ -0,0 +1,233 @@
+import argparse
+import math
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+import wind_turbine as wt
+
+"""
+Local hyperparameter search of the wind_turbine.py autoencoder, with parallel trials.
+The training shards are loaded once into a shared memory tensor, which all the trial
+processes read without copies. The trials train on one hold-out split of the windows
+and are ranked by the validation MSE (per window, so it is comparable across batch sizes).
+
+    random: every trial trains up to --max-epochs, and stops after --patience epochs
+            without improvement
+    halving: successive halving. All the trials train --min-epochs, then only the best
+             1/--eta of them continue with --eta times more epochs, and so on up to --max-epochs
+
+The leaderboard (leaderboard.json) also reports the parameters and the inference
+throughput of each model, to find a smaller, faster model that keeps the accuracy.
+It runs the same in the training container and on a laptop:
+
+    python3 hpo.py --train ../../data/train --strategy halving --trials 27 --workers 4
+"""
+
+RANDOM = 'random'
+HALVING = 'halving'
+
+# values sampled for each trial; learning_rate is log-uniform in the range
+SEARCH_SPACE = {
+    'batch_size': [64, 128, 256, 512],
+    'learning_rate': (1e-4, 1e-2),
+    'dropout_rate': [0.0, 0.001, 0.01, 0.1],
+    'model_width': [8, 16, 32],
+}
+
+# data of the trial processes, set once by init_worker
+DATA = {}
+
+
+def sample_params(rng):
+    low, high = SEARCH_SPACE['learning_rate']
+    return {
+        'batch_size': int(rng.choice(SEARCH_SPACE['batch_size'])),
+        'learning_rate': float(math.exp(rng.uniform(math.log(low), math.log(high)))),
+        'dropout_rate': float(rng.choice(SEARCH_SPACE['dropout_rate'])),
+        'model_width': int(rng.choice(SEARCH_SPACE['model_width'])),
+    }
+
+
+def load_dataset(data_dir):
+    """ All the windows of the training shards, in a shared memory tensor """
+    dataset = wt.WindTurbineDataset(data_dir)
+    x = torch.empty((len(dataset),) + dataset.sample_shape, dtype=torch.float32)
+    for shard, offset in zip(dataset.shards, dataset.offsets):
+        x[offset:offset + len(shard)] = torch.from_numpy(np.asarray(shard, dtype=np.float32))
+    return x.share_memory_()
+
+
+def init_worker(x, train_index, val_index, num_threads):
+    """ The tensors are received as shared memory handles, not copied """
+    torch.set_num_threads(num_threads)
+    DATA.update({'x': x, 'train_index': train_index, 'val_index': val_index})
+
+
+def validation_loss(model, x, val_index, batch_size=1024):
+    """ MSE per window over the validation windows """
+    model.eval()
+    total = 0.0
+    with torch.no_grad():
+        for start in range(0, len(val_index), batch_size):
+            batch = x[val_index[start:start + batch_size]]
+            total += ((model(batch) - batch) ** 2).mean(dim=(1, 2, 3)).sum().item()
+    return total / len(val_index)
+
+
+def run_trial(trial, epochs, patience=0):
+    """
+    Trains a trial up to `epochs` epochs in total, resuming from its (last epoch) state.
+    The model of the best epoch is kept in best_state, so it reproduces best_val_loss.
+    Returns the trial with its new states, losses and status
+    """
+    x, train_index, val_index = DATA['x'], DATA['train_index'], DATA['val_index']
+    params = trial['params']
+    torch.manual_seed(trial['seed'] + trial['epochs'])
+    model = wt.create_model(x.shape[1], params['dropout_rate'], params['model_width'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=params['learning_rate'])
+    if trial['state'] is not None:
+        model.load_state_dict(trial['state']['model'])
+        optimizer.load_state_dict(trial['state']['optimizer'])
+    criterion = nn.MSELoss()
+
+    start_time = time.time()
+    stalled_epochs = 0
+    while trial['epochs'] < epochs:
+        model.train()
+        permutation = train_index[torch.randperm(len(train_index))]
+        for start in range(0, len(permutation), params['batch_size']):
+            batch = x[permutation[start:start + params['batch_size']]]
+            optimizer.zero_grad()
+            loss = criterion(model(batch), batch)
+            loss.backward()
+            optimizer.step()
+        val_loss = validation_loss(model, x, val_index)
+        trial['epochs'] += 1
+        trial['val_losses'].append(val_loss)
+        if val_loss < trial['best_val_loss']:
+            trial['best_val_loss'] = val_loss
+            trial['best_state'] = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            stalled_epochs = 0
+        else:
+            stalled_epochs += 1
+        if 0 < patience <= stalled_epochs:
+            trial['status'] = 'stopped'
+            break
+
+    trial['train_time'] += time.time() - start_time
+    trial['state'] = {'model': model.state_dict(), 'optimizer': optimizer.state_dict()}
+    print("trial=%d; epochs=%d; val_loss=%.5f; best_val_loss=%.5f; params=%s" % (
+        trial['id'], trial['epochs'], trial['val_losses'][-1], trial['best_val_loss'], json.dumps(params)), flush=True)
+    return trial
+
+
+def get_rungs(min_epochs, max_epochs, eta):
+    """ Epoch budgets of the successive halving rungs: min_epochs * eta^i, up to max_epochs """
+    rungs = [min_epochs]
+    while rungs[-1] * eta < max_epochs:
+        rungs.append(rungs[-1] * eta)
+    return rungs + [max_epochs] if rungs[-1] < max_epochs else rungs
+
+
+def run_search(pool, trials, args):
+    if args.strategy == RANDOM:
+        return pool.starmap(run_trial, [(t, args.max_epochs, args.patience) for t in trials])
+
+    alive = trials
+    finished = []
+    for i, epochs in enumerate(get_rungs(args.min_epochs, args.max_epochs, args.eta)):
+        alive = pool.starmap(run_trial, [(t, epochs) for t in alive])
+        alive.sort(key=lambda t: t['best_val_loss'])
+        keep = max(1, int(math.ceil(len(alive) / float(args.eta))))
+        if epochs < args.max_epochs:
+            for t in alive[keep:]:
+                t['status'] = 'pruned'
+            print("rung=%d; epochs=%d; pruned %d of %d trials" % (i, epochs, len(alive) - keep, len(alive)))
+            finished += alive[keep:]
+            alive = alive[:keep]
+    return finished + alive
+
+
+def predict_throughput(model, x, repeat=3):
+    """ Inference windows per second of a model (best of `repeat`) """
+    model.eval()
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            model(x)
+            best = min(best, time.perf_counter() - start_time)
+    return len(x) / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', type=str, default=os.environ.get('SM_CHANNEL_TRAIN'), help='Training shards')
+    parser.add_argument('--output-dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR', 'hpo'))
+    parser.add_argument('--strategy', type=str, default=HALVING, choices=[RANDOM, HALVING])
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Trials trained concurrently')
+    parser.add_argument('--max-epochs', type=int, default=27)
+    parser.add_argument('--min-epochs', type=int, default=1, help='halving: epochs of the first rung')
+    parser.add_argument('--eta', type=int, default=3, help='halving: 1/eta of the trials continue in each rung')
+    parser.add_argument('--patience', type=int, default=3, help='random: epochs without improvement before a trial stops')
+    parser.add_argument('--validation-split', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.train is None:
+        raise Exception("--train (or SM_CHANNEL_TRAIN) is required")
+
+    x = load_dataset(args.train)
+    rng = np.random.RandomState(args.seed)
+    permutation = torch.from_numpy(rng.permutation(len(x)))
+    num_val = int(len(x) * args.validation_split)
+    val_index, train_index = permutation[:num_val], permutation[num_val:]
+    print("windows=%d; train=%d; validation=%d; strategy=%s; trials=%d" % (
+        len(x), len(train_index), len(val_index), args.strategy, args.trials))
+
+    trials = [{'id': i, 'params': sample_params(rng), 'seed': args.seed + i, 'state': None, 'best_state': None,
+               'epochs': 0, 'val_losses': [], 'best_val_loss': float('inf'), 'train_time': 0.0, 'status': 'completed'}
+              for i in range(args.trials)]
+
+    workers = max(1, min(args.workers, args.trials))
+    num_threads = max(1, os.cpu_count() // workers)
+    start_time = time.time()
+    with wt.create_pool(workers, init_worker, (x, train_index, val_index, num_threads)) as pool:
+        trials = run_search(pool, trials, args)
+    print("search: elapsed_time=%.1fs" % (time.time() - start_time))
+
+    # size and speed of each model, measured here one at a time so the trials don't compete
+    torch.set_num_threads(os.cpu_count())
+    sample = x[val_index[:1024]]
+    leaderboard = []
+    for t in trials:
+        model = wt.create_model(x.shape[1], t['params']['dropout_rate'], t['params']['model_width'])
+        # the best epoch model: the one of best_val_loss (a diverged trial has none, the last one is used)
+        model.load_state_dict(t['best_state'] if t['best_state'] is not None else t['state']['model'])
+        leaderboard.append({
+            'trial': t['id'],
+            'status': t['status'],
+            'best_val_loss': t['best_val_loss'],
+            'epochs': t['epochs'],
+            'train_time': t['train_time'],
+            'num_parameters': sum(p.numel() for p in model.parameters()),
+            'predict_samples_per_second': predict_throughput(model, sample),
+            'params': t['params'],
+        })
+    leaderboard.sort(key=lambda r: (r['status'] == 'pruned', r['best_val_loss']))
+
+    for r in leaderboard:
+        print("trial=%(trial)d; status=%(status)s; best_val_loss=%(best_val_loss).5f; epochs=%(epochs)d; "
+              "num_parameters=%(num_parameters)d; predict_samples_per_second=%(predict_samples_per_second).0f" % r)
+    best = leaderboard[0]
+    print("best: " + " ".join("--%s %s" % (k, v) for k, v in sorted(best['params'].items())))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'leaderboard.json'), 'w') as f:
+        json.dump({'strategy': args.strategy, 'windows': len(x), 'leaderboard': leaderboard}, f, indent=2)
+    print("leaderboard saved to %s" % os.path.join(args.output_dir, 'leaderboard.json'))
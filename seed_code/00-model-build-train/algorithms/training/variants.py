@@ -0,0 +1,214 @@
+import copy
+import json
+import math
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+try:
+    from torch.ao import quantization as tq
+except ImportError:
+    from torch import quantization as tq
+
+import wind_turbine as wt
+
+"""
+Slimmer variants of the wind_turbine.py autoencoder, to pick the best size/latency
+tradeoff for each class of edge gateway:
+    width_<m>: the model retrained with m times the channels of each layer
+    pruned_<a>: structured pruning of the fraction a of the channels of each hidden layer
+                (lowest L1 norm), then fine tuned
+    *_int8: post-training static int8 quantization of the encoder, calibrated on training
+            windows. Dynamic quantization only covers linear/recurrent layers, so it doesn't apply here
+Each variant is saved as TorchScript (variants/<name>/model.pt) and reported in
+variants/report.json with its parameter count, size, latency per window (batch 1, cpu) and
+the change of its reconstruction errors and anomaly flags vs the base model.
+Called by wind_turbine.py when --variant_widths, --variant_pruning or --variant_int8 are set.
+"""
+
+CONV_LAYERS = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def parse_list(value):
+    """ '0.5,0.25' -> [0.5, 0.25]; the hyperparameters are passed as strings """
+    return [float(v) for v in value.split(',') if v.strip() != '']
+
+
+def get_quantization_engine(engine=None):
+    """ x86 (fbgemm on older versions) for the X86_64 gateways, qnnpack for arm """
+    supported = torch.backends.quantized.supported_engines
+    if engine is None:
+        engine = 'x86' if 'x86' in supported else 'fbgemm'
+    if engine not in supported:
+        raise Exception("Quantization engine %s not supported. Use one of %s" % (engine, supported))
+    return engine
+
+
+def __copy_conv__(layer, in_index, out_index):
+    """ Copy of a conv layer with only the selected input and output channels """
+    transposed = isinstance(layer, nn.ConvTranspose2d)
+    new_layer = type(layer)(len(in_index), len(out_index), layer.kernel_size, stride=layer.stride,
+                            padding=layer.padding, dilation=layer.dilation, bias=layer.bias is not None)
+    # Conv2d weights are (out, in, h, w), ConvTranspose2d weights are (in, out, h, w)
+    weight = layer.weight.data[in_index][:, out_index] if transposed else layer.weight.data[out_index][:, in_index]
+    new_layer.weight.data.copy_(weight)
+    if layer.bias is not None:
+        new_layer.bias.data.copy_(layer.bias.data[out_index])
+    return new_layer
+
+
+def prune_channels(model, amount):
+    """
+    Structured pruning of a Sequential of convs: each hidden conv keeps the (1 - amount)
+    output channels with the largest L1 norm and the next conv keeps the matching inputs.
+    The layers are rebuilt smaller, so the pruning also cuts the latency
+    """
+    layers = list(model)
+    convs = [i for i, layer in enumerate(layers) if isinstance(layer, CONV_LAYERS)]
+    in_index = torch.arange(layers[convs[0]].in_channels)
+    pruned = []
+    for i, layer in enumerate(layers):
+        if not isinstance(layer, CONV_LAYERS):
+            pruned.append(copy.deepcopy(layer))
+            continue
+        if i == convs[-1]:
+            # the output layer reconstructs all the features
+            out_index = torch.arange(layer.out_channels)
+        else:
+            weight = layer.weight.data.abs()
+            norms = weight.sum(dim=(0, 2, 3)) if isinstance(layer, nn.ConvTranspose2d) else weight.sum(dim=(1, 2, 3))
+            keep = max(1, int(math.ceil(layer.out_channels * (1.0 - amount))))
+            out_index = torch.sort(torch.topk(norms, keep).indices).values
+        pruned.append(__copy_conv__(layer, in_index, out_index))
+        in_index = out_index
+    return nn.Sequential(*pruned)
+
+
+def quantize_static(model, calibration, engine=None, batch_size=256):
+    """
+    Post-training static int8 quantization (eager mode) of the encoder of a model of
+    create_model, calibrated on `calibration` windows. The conv + relu pairs are fused.
+    The decoder stays in float32: the quantized ConvTranspose2d kernels of the x86/onednn
+    engines give wrong outputs when the input and output channels differ. Runs on cpu only
+    """
+    engine = get_quantization_engine(engine)
+    torch.backends.quantized.engine = engine
+    layers = list(copy.deepcopy(model).cpu())
+    split = next(i for i, layer in enumerate(layers) if isinstance(layer, nn.ConvTranspose2d))
+    encoder = nn.Sequential(*layers[:split])
+    fuse = [[str(i), str(i + 1)] for i, layer in enumerate(layers[:split - 1])
+            if isinstance(layer, nn.Conv2d) and isinstance(layers[i + 1], nn.ReLU)]
+    encoder = tq.fuse_modules(encoder.eval(), fuse)
+    quantized = nn.Sequential(tq.QuantStub(), encoder, tq.DeQuantStub(), nn.Sequential(*layers[split:])).eval()
+    for module in list(quantized)[:3]:
+        module.qconfig = tq.get_default_qconfig(engine)
+    tq.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(calibration), batch_size):
+            quantized(calibration[start:start + batch_size])
+    tq.convert(quantized, inplace=True)
+    return quantized
+
+
+def finetune(model, train_dataloader, test_dataloader, args, epochs):
+    """ A few epochs of wind_turbine.train_epoch on the fold, i.e. after the pruning """
+    model = model.to(wt.device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=wt.get_learning_rate(args))
+    for epoch in range(epochs):
+        train_loss, test_loss, _ = wt.train_epoch(optimizer, nn.MSELoss(), epoch, model, train_dataloader, test_dataloader)
+        print("finetune epoch=%d; train_loss=%.3f; test_loss=%.3f" % (epoch, train_loss, test_loss))
+    return model.cpu().eval()
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def window_errors(model, dataloader):
+    """ wind_turbine.reconstruction_errors of the windows of a dataloader, on cpu """
+    model.eval()
+    errors = []
+    with torch.no_grad():
+        for x, _ in dataloader:
+            errors.append(wt.reconstruction_errors(model(x), x))
+    return torch.cat(errors).numpy()
+
+
+def window_latency(model, window, repeat=200):
+    """ Median latency (ms) of one window (batch 1) """
+    latencies = []
+    with torch.no_grad():
+        model(window)
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            model(window)
+            latencies.append(time.perf_counter() - start_time)
+    return float(np.median(latencies)) * 1000.0
+
+
+def build_variants(model, args, train_index, test_index, output_dir):
+    """
+    Builds, saves and reports the variants of the trained (float32) model on the fold of
+    train_index/test_index. Returns the report
+    """
+    dataset = wt.WindTurbineDataset(args.train)
+    train_dataloader = wt.create_dataloader(torch.utils.data.Subset(dataset, train_index), args, shuffle=True)
+    test_dataloader = wt.create_dataloader(torch.utils.data.Subset(dataset, test_index), args)
+    calibration_index = np.sort(np.random.RandomState(0).permutation(train_index)[:args.variant_calibration_windows])
+    calibration = torch.stack([x for x, _ in dataset.__getitems__(calibration_index)])
+
+    base = copy.deepcopy(model).cpu().eval()
+    variants = [('base', base, count_parameters(base))]
+    for multiplier in parse_list(args.variant_widths):
+        width_args = copy.copy(args)
+        width_args.model_width = max(1, int(round(args.model_width * multiplier)))
+        print("\nTraining width_%g: model_width=%d" % (multiplier, width_args.model_width))
+        _, state, _ = wt.train_fold(width_args, -1, train_index, test_index)
+        width_model = wt.create_model(dataset.num_features, args.dropout_rate, width_args.model_width)
+        width_model.load_state_dict(state)
+        variants.append(('width_%g' % multiplier, width_model.eval(), count_parameters(width_model)))
+    for amount in parse_list(args.variant_pruning):
+        print("\nPruning %g of the channels" % amount)
+        pruned = finetune(prune_channels(base, amount), train_dataloader, test_dataloader, args, args.variant_finetune_epochs)
+        variants.append(('pruned_%g' % amount, pruned, count_parameters(pruned)))
+    if args.variant_int8 == 1:
+        engine = args.quantization_engine or None
+        # same parameters as the float32 variant, stored in int8
+        variants += [(name + '_int8', quantize_static(m, calibration, engine), n) for name, m, n in list(variants)]
+
+    # latency of the gateways: one window at a time, on few threads
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(args.variant_latency_threads)
+    window = calibration[:1]
+    base_errors = window_errors(base, test_dataloader)
+    thresholds = np.percentile(base_errors, args.threshold_percentile, axis=0)
+    report = []
+    for name, variant, num_parameters in variants:
+        path = os.path.join(output_dir, name)
+        os.makedirs(path, exist_ok=True)
+        with torch.no_grad():
+            traced = torch.jit.trace(variant, window)
+        traced.save(os.path.join(path, wt.TORCHSCRIPT_MODEL))
+        errors = window_errors(variant, test_dataloader)
+        report.append({
+            'variant': name,
+            'num_parameters': num_parameters,
+            'size_bytes': os.path.getsize(os.path.join(path, wt.TORCHSCRIPT_MODEL)),
+            'latency_ms': window_latency(traced, window),
+            'mean_error': float(errors.mean()),
+            'error_delta': float(errors.mean() / base_errors.mean() - 1.0),
+            'max_error_diff': float(np.abs(errors - base_errors).max()),
+            # anomaly flags that change with the thresholds of the base model
+            'flag_changes': float(((errors > thresholds) != (base_errors > thresholds)).mean())
+        })
+    torch.set_num_threads(num_threads)
+
+    print("\nVariants (latency of 1 window on %d threads):" % args.variant_latency_threads)
+    for r in report:
+        print("%(variant)-16s num_parameters=%(num_parameters)d; size=%(size_bytes)d; latency=%(latency_ms).3fms; "
+              "mean_error=%(mean_error).5f; error_delta=%(error_delta)+.2f%%; flag_changes=%(flag_changes).2f%%" % dict(
+                  r, error_delta=r['error_delta'] * 100.0, flag_changes=r['flag_changes'] * 100.0))
+    with open(os.path.join(output_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
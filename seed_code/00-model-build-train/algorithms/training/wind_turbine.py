@@ -1,125 +1,493 @@
 import argparse
+import contextlib
 import glob
+import inspect
+import io
+import json
 import numpy as np
 import os
 import shutil
+import sys
 import time
 import torch
 import torch.nn as nn
-import torch.optim as optim
-from   torch.autograd import Variable
 from   sklearn.model_selection import KFold
 
+# the arrow shards format of preprocessing.py is next to this file (training job and model code),
+# or in ../preprocessing when running from the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+import arrow_format
+from arrow_format import ARROW_CONTENT_TYPE, read_arrow
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-def create_model(n_features, dropout=0):    
+# autocast dtypes of --precision; the weights and the loss stay in float32
+PRECISIONS = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+# precision and memory format used by predict_fn, saved next to model.pth
+INFERENCE_CONFIG = 'inference_config.json'
+# inference artifacts exported next to model.pth: frozen TorchScript and ONNX (dynamic and fixed batch)
+TORCHSCRIPT_MODEL = 'model.pt'
+ONNX_MODEL = 'model.onnx'
+ONNX_FIXED_BATCH_MODEL = 'model_b%d.onnx'
+
+# output of predict_fn, set with the TRANSFORM_OUTPUT env var of the model:
+#   reconstruction: the model output (n, features, 10, 10)
+#   errors: per-window, per-feature mean abs reconstruction error (n, features)
+#   anomalies: errors and per-feature anomaly flags (1.0/0.0) against thresholds.npy (n, 2, features)
+OUTPUT_RECONSTRUCTION = 'reconstruction'
+OUTPUT_ERRORS = 'errors'
+OUTPUT_ANOMALIES = 'anomalies'
+OUTPUTS = (OUTPUT_RECONSTRUCTION, OUTPUT_ERRORS, OUTPUT_ANOMALIES)
+THRESHOLDS_FILE = 'thresholds.npy'
+NPY_CONTENT_TYPE = 'application/x-npy'
+
+def create_model(n_features, dropout=0, width=32):    
+    """ width: channels of the first layer (the next ones have 2x and 4x). Smaller is faster """
     return torch.nn.Sequential(
-        torch.nn.Conv2d(n_features, 32, kernel_size=2, padding=1),
+        torch.nn.Conv2d(n_features, width, kernel_size=2, padding=1),
         torch.nn.ReLU(),
         torch.nn.Dropout(dropout),
-        torch.nn.Conv2d(32, 64, kernel_size=2, padding=1),
+        torch.nn.Conv2d(width, width * 2, kernel_size=2, padding=1),
         torch.nn.ReLU(),
         torch.nn.Dropout(dropout),
-        torch.nn.Conv2d(64, 128, kernel_size=2, padding=2),
+        torch.nn.Conv2d(width * 2, width * 4, kernel_size=2, padding=2),
         torch.nn.ReLU(),
-        torch.nn.ConvTranspose2d(128, 64, kernel_size=2, padding=2),
+        torch.nn.ConvTranspose2d(width * 4, width * 2, kernel_size=2, padding=2),
         torch.nn.ReLU(),
         torch.nn.Dropout(dropout),
-        torch.nn.ConvTranspose2d(64, 32, kernel_size=2, padding=1),
+        torch.nn.ConvTranspose2d(width * 2, width, kernel_size=2, padding=1),
         torch.nn.ReLU(),
         torch.nn.Dropout(dropout),
-        torch.nn.ConvTranspose2d(32, n_features, kernel_size=2, padding=1),
+        torch.nn.ConvTranspose2d(width, n_features, kernel_size=2, padding=1),
     )    
 
-def load_data(data_dir):
-    input_files = glob.glob(os.path.join(data_dir, '*.npy'))
-    data = [np.load(i) for i in input_files]
-    return np.vstack(data)    
+@contextlib.contextmanager
+def no_autocast():
+    """ No-op context of the float32 forward passes (contextlib.nullcontext needs python 3.7) """
+    yield
+
+def supported_precisions():
+    """
+    --precision values supported by the installed torch on the current device: torch.autocast
+    (any dtype, cpu and gpu) needs torch 1.10; torch 1.6 only has float16 autocast on gpu
+    """
+    if hasattr(torch, 'autocast'):
+        return sorted(PRECISIONS.keys())
+    if device == 'cuda' and hasattr(torch.cuda, 'amp') and hasattr(torch.cuda.amp, 'autocast'):
+        return ['float16', 'float32']
+    return ['float32']
+
+def check_precision(precision):
+    if precision not in supported_precisions():
+        raise Exception("Precision %s not supported by torch %s on %s. Use one of %s" % (
+            precision, torch.__version__, device, supported_precisions()))
+
+def autocast(precision):
+    """ Mixed precision context of the forward passes; float32 runs as is """
+    if precision == 'float32':
+        return no_autocast()
+    check_precision(precision)
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device, dtype=PRECISIONS[precision])
+    return torch.cuda.amp.autocast()
+
+def to_memory_format(x, channels_last):
+    """ NHWC layout (tensor or model) for the channels last path, often faster for the convolutions on cpu """
+    return x.to(memory_format=torch.channels_last) if channels_last else x
+
+def reconstruction_errors(p, x):
+    """ Per-window, per-feature mean abs error: (..., features, H, W) -> (..., features) """
+    return (p - x).abs().mean(dim=(-2, -1))
+
+def validation_errors(model, dataloader, precision='float32', channels_last=False):
+    """ reconstruction_errors of all the windows of a dataloader, in one pass (n, features) """
+    model.eval()
+    errors = []
+    with torch.no_grad():
+        for x, _ in dataloader:
+            x = to_memory_format(x.to(device, non_blocking=True), channels_last)
+            with autocast(precision):
+                p = model(x).float()
+            errors.append(reconstruction_errors(p, x).cpu())
+    return torch.cat(errors).numpy()
+
+class WindTurbineDataset(torch.utils.data.Dataset):
+    """
+    Lazy dataset over the training shards of a directory, for datasets larger than the RAM.
+    The npy shards are memory mapped and indexed across through the offset of each shard,
+    so only the samples of the current batch are read. Each sample is an (x, x) pair.
+    The arrow shards are compressed, so they are decompressed into memory when opened.
+    The dataset can be pickled (i.e. DataLoader workers): the shards are opened again, not copied.
+    The folds are index views: torch.utils.data.Subset(dataset, indices)
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        input_files = sorted(glob.glob(os.path.join(data_dir, '*.npy')))
+        self.shards = [np.load(i, mmap_mode='r') for i in input_files]
+        self.shards += [read_arrow(i) for i in sorted(glob.glob(os.path.join(data_dir, '*.arrow')))]
+        self.shards = [s for s in self.shards if len(s) > 0]
+        if len(self.shards) == 0:
+            raise Exception("No training data found in %s" % data_dir)
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+        self.sample_shape = self.shards[0].shape[1:]
+        self.num_features = self.sample_shape[0]
 
-def train_epoch(optimizer, criterion, epoch, model, train_dataloader, test_dataloader):
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        return {'data_dir': self.data_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['data_dir'])
+
+    def __locate__(self, indices):
+        """ global indices -> (shard ids, indices in the shard) """
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        return shard_ids, indices - self.offsets[shard_ids]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard_id, local_idx = self.__locate__(idx)
+        x = torch.from_numpy(np.array(self.shards[shard_id][local_idx], dtype=np.float32))
+        return x, x
+
+    def __getitems__(self, indices):
+        """ Batched read used by the DataLoader: one sorted read per shard instead of one per sample """
+        indices = np.asarray(indices)
+        shard_ids, local_indices = self.__locate__(indices)
+        batch = np.empty((len(indices),) + self.sample_shape, dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            # the shard is read in index order, then the samples go back to the sampler order
+            positions = np.flatnonzero(shard_ids == shard_id)
+            positions = positions[np.argsort(local_indices[positions], kind='stable')]
+            batch[positions] = self.shards[shard_id][local_indices[positions]]
+        batch = torch.from_numpy(batch)
+        return [(x, x) for x in batch]
+
+def train_epoch(optimizer, criterion, epoch, model, train_dataloader, test_dataloader,
+                precision='float32', channels_last=False, scaler=None):
+    """ Returns the train loss, the test loss and the time spent on the training batches """
     train_loss = 0.0    
     test_loss = 0.0    
+    start_time = time.time()
     model.train()
     for x_train, y_train in train_dataloader:
+        # no-op on cpu; asynchronous copy from the pinned batches on gpu
+        x_train, y_train = x_train.to(device, non_blocking=True), y_train.to(device, non_blocking=True)
+        x_train = to_memory_format(x_train, channels_last)
         # clearing the Gradients of the model parameters
         optimizer.zero_grad()
         # prediction for training and validation set        
-        output_train = model(x_train)        
-        loss_train = criterion(output_train, y_train)
+        with autocast(precision):
+            output_train = model(x_train)        
+        loss_train = criterion(output_train.float(), y_train)
                 
         # computing the updated weights of all the model parameters
         # statistics
         train_loss += loss_train.item()
-        loss_train.backward()
-        optimizer.step()        
+        if scaler is None:
+            loss_train.backward()
+            optimizer.step()        
+        else:
+            # float16 gradients on gpu: the loss is scaled to avoid underflows
+            scaler.scale(loss_train).backward()
+            scaler.step(optimizer)
+            scaler.update()
+    train_time = time.time() - start_time
     model.eval()
-    for x_test, y_test in test_dataloader:            
-        output_test = model(x_test.float())
-        loss_test = criterion(output_test, y_test)
-        # statistics
-        test_loss += loss_test.item()                
+    with torch.no_grad():
+        for x_test, y_test in test_dataloader:            
+            x_test, y_test = x_test.to(device, non_blocking=True), y_test.to(device, non_blocking=True)
+            with autocast(precision):
+                output_test = model(to_memory_format(x_test, channels_last))
+            loss_test = criterion(output_test.float(), y_test)
+            # statistics
+            test_loss += loss_test.item()                
         
-    return train_loss, test_loss
+    return train_loss, test_loss, train_time
+
+def get_learning_rate(args):
+    """ learning_rate is tuned for base_batch_size; scales it to batch_size """
+    ratio = args.batch_size / args.base_batch_size
+    if args.lr_scaling == 'linear':
+        return args.learning_rate * ratio
+    if args.lr_scaling == 'sqrt':
+        return args.learning_rate * np.sqrt(ratio)
+    return args.learning_rate
+
+def create_dataloader(dataset, args, shuffle=False):
+    """
+    Batches of the fold: shuffled every epoch (train), read by num_workers processes
+    with prefetch_factor batches in flight each, and in pinned memory for gpu transfers
+    """
+    options = {}
+    # prefetch_factor and persistent_workers were added in torch 1.7
+    if args.num_workers > 0 and 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader).parameters:
+        options = {'prefetch_factor': args.prefetch_factor, 'persistent_workers': True}
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle,
+        num_workers=args.num_workers, pin_memory=args.pin_memory and device == 'cuda', **options)
+
+def train_fold(args, fold, train_index, test_index):
+    """
+    Trains the model of one fold, with early stopping on the test loss.
+    The best state is kept in memory (on cpu) and returned with the summary of the fold
+    and the reconstruction errors of the best state on the validation fold
+    """
+    best_loss = float('inf')
+    best_state, best_epoch = None, -1
+    # reference of the patience: only moves on improvements larger than min_delta
+    patience_loss = float('inf')
+    stalled_epochs = 0
+    fold_start_time = time.time()
+    criterion = nn.MSELoss()
+    # each process opens its own memory maps, so only the indices are sent to the workers
+    dataset = WindTurbineDataset(args.train)
+
+    print("Test dataset proportion: %.02f%%" % (len(test_index)/len(train_index) * 100))
+    # the folds are index views of the memory mapped shards, the batches are read on demand
+    train_dataset = torch.utils.data.Subset(dataset, train_index)
+    train_dataloader = create_dataloader(train_dataset, args, shuffle=args.shuffle == 1)
+    test_dataset = torch.utils.data.Subset(dataset, test_index)
+    test_dataloader = create_dataloader(test_dataset, args)
+
+    model = create_model(dataset.num_features, args.dropout_rate, args.model_width)
+    model = to_memory_format(model.to(device), args.channels_last == 1)
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=get_learning_rate(args))
+    scaler = None
+    if args.precision == 'float16' and device == 'cuda':
+        scaler = torch.cuda.amp.GradScaler()
+    # Training loop
+    for epoch in range(args.num_epochs):
+        start_time = time.time()
+        train_loss, test_loss, train_time = train_epoch( optimizer, criterion, epoch, model, train_dataloader, test_dataloader,
+            args.precision, args.channels_last == 1, scaler)
+        elapsed_time = (time.time() - start_time)
+        print("k=%d; epoch=%d; train_loss=%.3f; test_loss=%.3f; elapsed_time=%.3fs; samples_per_second=%.0f" % (
+            fold, epoch, train_loss, test_loss, elapsed_time, len(train_dataset) / train_time), flush=True)
+        # a NaN loss is never an improvement
+        improved = test_loss < best_loss
+        if improved:
+            best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+            best_epoch = epoch
+        best_loss = test_loss if improved else best_loss
+        # only improvements larger than min_delta reset the patience, so a run of
+        # smaller improvements doesn't keep moving the reference
+        if test_loss < patience_loss - args.early_stopping_min_delta:
+            patience_loss, stalled_epochs = test_loss, 0
+        else:
+            stalled_epochs += 1
+        if 0 < args.early_stopping_patience <= stalled_epochs and epoch + 1 < args.num_epochs:
+            print("k=%d; early stop after %d epochs without improvement" % (fold, stalled_epochs))
+            break
+
+    if best_state is None:
+        # no finite test loss (i.e. diverged): the last state is kept
+        print("k=%d; no test loss improvement, keeping the last state" % fold)
+        best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+    model.load_state_dict(best_state)
+    errors = validation_errors(model, test_dataloader, args.precision, args.channels_last == 1)
+
+    summary = {
+        'fold': fold,
+        'best_loss': best_loss,
+        'best_epoch': best_epoch,
+        'epochs': epoch + 1,
+        'early_stop': epoch + 1 < args.num_epochs,
+        'elapsed_time': time.time() - fold_start_time,
+        'thresholds': np.percentile(errors, args.threshold_percentile, axis=0).tolist()
+    }
+    return summary, best_state, errors
+
+def export_model(model, model_dir, num_features, batch_size=1):
+    """
+    Exports the float32 model as a traced (and frozen, when supported) TorchScript module, and as
+    ONNX graphs with a dynamic and a fixed (batch_size) batch dim. The input is named input0, as in the
+    DataInputConfig of the Neo compilation. The ONNX export is optional: failures are only logged
+    """
+    model = model.to('cpu').eval()
+    example = torch.zeros(batch_size, num_features, 10, 10)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    # torch.jit.freeze (weights inlined as constants) is only available from torch 1.7
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    traced.save(os.path.join(model_dir, TORCHSCRIPT_MODEL))
+
+    # newer versions export through torch.export by default, which needs onnxscript
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    exports = [
+        (ONNX_MODEL, {'input0': {0: 'batch'}, 'output0': {0: 'batch'}}),
+        (ONNX_FIXED_BATCH_MODEL % batch_size, None)
+    ]
+    for name, dynamic_axes in exports:
+        try:
+            torch.onnx.export(model, example, os.path.join(model_dir, name), input_names=['input0'],
+                              output_names=['output0'], dynamic_axes=dynamic_axes, opset_version=11, **options)
+        except Exception as e:
+            print("ONNX export of %s failed: %s" % (name, e))
+
+def init_fold_worker(num_threads):
+    """ Limits the threads of each fold process, so the folds don't compete for the cores """
+    torch.set_num_threads(num_threads)
+
+def create_pool(processes, initializer, initargs):
+    """ Process pool of the folds (and of the hpo trials) """
+    # spawn: forked processes would inherit the OpenMP state of the parent
+    ctx = torch.multiprocessing.get_context('spawn')
+    return ctx.Pool(processes, initializer=initializer, initargs=initargs)
 
 def train(args):
-    best_of_the_best = (0,-1)
-    best_loss = 10000000
-    num_epochs = args.num_epochs
-    batch_size = args.batch_size    
-    
-    X = load_data(args.train)
-    criterion = nn.MSELoss()    
+    dataset = WindTurbineDataset(args.train)
+    num_features = dataset.num_features
     kf = KFold(n_splits=args.k_fold_splits, shuffle=True)
-    num_features = X.shape[1]
-    
-    for i, indexes in enumerate(kf.split(X)):
-        # skip other Ks if fixed was informed
-        if args.k_index_only >= 0 and args.k_index_only != i: continue
-
-        train_index, test_index = indexes
-        print("Test dataset proportion: %.02f%%" % (len(test_index)/len(train_index) * 100))
-        X_train, X_test = X[train_index], X[test_index]
-        X_train = torch.from_numpy(X_train).float().to(device)
-        X_test = torch.from_numpy(X_test).float().to(device)
-
-        train_dataset = torch.utils.data.TensorDataset(X_train, X_train)
-        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size)
-        test_dataset = torch.utils.data.TensorDataset(X_test, X_test)
-        test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size)
-
-        model = create_model(num_features, args.dropout_rate)
-        model = model.to(device)
-
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
-        # Instantiate model
-        # Training loop
-        for epoch in range(num_epochs):
-            start_time = time.time()
-            train_loss, test_loss = train_epoch( optimizer, criterion, epoch, model, train_dataloader, test_dataloader)
-            elapsed_time = (time.time() - start_time)
-            print("k=%d; epoch=%d; train_loss=%.3f; test_loss=%.3f; elapsed_time=%.3fs" % (i, epoch, train_loss, test_loss, elapsed_time))
-            if test_loss < best_loss:                
-                torch.save(model.state_dict(), os.path.join(args.output_data_dir,'model_state.pth'))
-                best_loss = test_loss
-                if best_loss < best_of_the_best[0]:
-                    best_of_the_best = (best_loss, i)
-    print("\nBest model: best_mse=%f;" % best_loss)
-    model = create_model(num_features, args.dropout_rate)
-    model.load_state_dict( torch.load(os.path.join(args.output_data_dir, "model_state.pth")) )
+
+    # skip other Ks if fixed was informed
+    folds = [(args, i, train_index, test_index)
+             for i, (train_index, test_index) in enumerate(kf.split(np.arange(len(dataset))))
+             if args.k_index_only < 0 or args.k_index_only == i]
+
+    num_processes = min(args.parallel_folds, len(folds))
+    if num_processes > 1:
+        num_threads = args.threads_per_fold if args.threads_per_fold > 0 else max(1, os.cpu_count() // num_processes)
+        print("Training %d folds in %d processes; threads_per_fold=%d" % (len(folds), num_processes, num_threads))
+        if args.num_workers > 0:
+            # the pool processes can't have children: each fold reads its own batches
+            print("num_workers=%d ignored with parallel_folds" % args.num_workers)
+            args.num_workers = 0
+        with create_pool(num_processes, init_fold_worker, (num_threads,)) as pool:
+            results = pool.starmap(train_fold, folds)
+    else:
+        results = [train_fold(*fold) for fold in folds]
+
+    print("\nFolds summary:")
+    for summary, _, _ in results:
+        print("k=%(fold)d; best_epoch=%(best_epoch)d; epochs=%(epochs)d; best_mse=%(best_loss)f; "
+              "early_stop=%(early_stop)s; elapsed_time=%(elapsed_time).1fs" % summary)
+    with open(os.path.join(args.output_data_dir, 'folds_summary.json'), 'w') as f:
+        json.dump([summary for summary, _, _ in results], f, indent=2)
+
+    summary, best_state, best_errors = min(results, key=lambda r: r[0]['best_loss'])
+    print("\nBest model: best_mse=%f; k=%d" % (summary['best_loss'], summary['fold']))
+    # the only checkpoint written: the best state of the best fold
+    torch.save(best_state, os.path.join(args.output_data_dir, 'model_state.pth'))
+    model = create_model(num_features, args.dropout_rate, args.model_width)
+    model.load_state_dict(best_state)
     os.mkdir(os.path.join(args.model_dir,'code'))
     shutil.copyfile(__file__, os.path.join(args.model_dir, 'code/inference.py'))
+    shutil.copyfile(arrow_format.__file__, os.path.join(args.model_dir, 'code/arrow_format.py'))
     torch.save(model, os.path.join(args.model_dir, "model.pth"))
+    export_model(model, args.model_dir, num_features, args.export_batch_size)
+
+    # anomaly thresholds: percentile of the errors of the shipped model on its validation fold
+    thresholds = np.percentile(best_errors, args.threshold_percentile, axis=0).astype(np.float32)
+    np.save(os.path.join(args.model_dir, THRESHOLDS_FILE), thresholds)
+    print("Thresholds (p%g of %d validation windows): %s" % (
+        args.threshold_percentile, len(best_errors), ",".join(thresholds.astype(str))))
 
+    if args.variant_widths != '' or args.variant_pruning != '' or args.variant_int8 == 1:
+        # variants.py is next to this file in the training job only (source_dir), not in the model code
+        import variants
+        _, _, train_index, test_index = [f for f in folds if f[1] == summary['fold']][0]
+        variants.build_variants(model, args, train_index, test_index, os.path.join(args.output_data_dir, 'variants'))
+    with open(os.path.join(args.model_dir, INFERENCE_CONFIG), 'w') as f:
+        json.dump({'precision': args.precision, 'channels_last': args.channels_last == 1}, f)
+
+
+def load_model(model_dir):
+    """ The TorchScript module when exported (faster to load, no code dependency), else the pickled model """
+    torchscript_path = os.path.join(model_dir, TORCHSCRIPT_MODEL)
+    if os.path.exists(torchscript_path):
+        # map_location moves the weights (constants of the graph when frozen) to the device
+        return torch.jit.load(torchscript_path, map_location=device)
+    return torch.load(os.path.join(model_dir, "model.pth"), map_location=device)
 
 def model_fn(model_dir):
-    model = torch.load(os.path.join(model_dir, "model.pth"))
-    model = model.to(device)
+    model = load_model(model_dir)
+    # precision and memory format of the training, if any
+    config = {'precision': 'float32', 'channels_last': False}
+    config_path = os.path.join(model_dir, INFERENCE_CONFIG)
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            config.update(json.load(f))
+    model.precision, model.channels_last = config['precision'], config['channels_last']
+    model.output = os.environ.get('TRANSFORM_OUTPUT', OUTPUT_RECONSTRUCTION)
+    if model.output not in OUTPUTS:
+        raise Exception("Invalid TRANSFORM_OUTPUT '%s'. Use one of %s" % (model.output, OUTPUTS))
+    model.batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', 1024))
+    model.thresholds = None
+    if model.output == OUTPUT_ANOMALIES:
+        thresholds_path = os.path.join(model_dir, THRESHOLDS_FILE)
+        if not os.path.exists(thresholds_path):
+            raise Exception("TRANSFORM_OUTPUT=%s requires %s in the model" % (OUTPUT_ANOMALIES, THRESHOLDS_FILE))
+        model.thresholds = torch.from_numpy(np.load(thresholds_path).astype(np.float32)).to(device)
+    model = to_memory_format(model.to(device), model.channels_last)
     model.eval()
     return model
 
+def decode_npy(input_data):
+    """ npy payload -> array over the payload buffer, without copying the data """
+    f = io.BytesIO(input_data)
+    version = np.lib.format.read_magic(f)
+    if version not in [(1, 0), (2, 0)]:
+        return np.load(f, allow_pickle=False)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(f)
+    data = np.frombuffer(input_data, dtype=dtype, count=int(np.prod(shape)), offset=f.tell())
+    if fortran_order:
+        return data.reshape(shape[::-1]).transpose()
+    return data.reshape(shape)
+
+def input_fn(input_data, content_type):
+    """
+    Decodes the npy and the arrow payloads into arrays; the other content types are handled
+    as in the default input_fn. The npy arrays are read-only views of the payload
+    """
+    if content_type == NPY_CONTENT_TYPE:
+        return decode_npy(input_data)
+    if content_type == ARROW_CONTENT_TYPE:
+        return read_arrow(input_data)
+    from sagemaker_inference import decoder
+    return np.asarray(decoder.decode(input_data, content_type))
+
 def predict_fn(input_data, model):    
+    """
+    Runs the model in mini-batches of model.batch_size (INFERENCE_BATCH_SIZE) windows and
+    returns the reconstruction, the errors or the anomalies (see TRANSFORM_OUTPUT)
+    """
+    precision = getattr(model, 'precision', 'float32')
+    output = getattr(model, 'output', OUTPUT_RECONSTRUCTION)
+    batch_size = getattr(model, 'batch_size', len(input_data)) or len(input_data)
+    results = []
     with torch.no_grad():
-        return model(input_data.float().to(device))
+        for start in range(0, len(input_data), batch_size):
+            batch = input_data[start:start + batch_size]
+            if isinstance(batch, np.ndarray):
+                # only the batch is copied out of the (read-only) payload
+                batch = torch.from_numpy(np.array(batch, dtype=np.float32))
+            x = to_memory_format(batch.float().to(device), getattr(model, 'channels_last', False))
+            with autocast(precision):
+                p = model(x).float()
+            if output == OUTPUT_RECONSTRUCTION:
+                results.append(p.contiguous())
+                continue
+            errors = reconstruction_errors(p, x)
+            if output == OUTPUT_ANOMALIES:
+                errors = torch.stack([errors, (errors > model.thresholds).float()], dim=1)
+            results.append(errors)
+    return torch.cat(results) if len(results) > 0 else torch.empty(0)
+
+def output_fn(prediction, accept):
+    """ Encodes the predictions as npy without the generic encoder; the other types use the default one """
+    prediction = prediction.cpu().numpy()
+    if accept == NPY_CONTENT_TYPE:
+        buffer = io.BytesIO()
+        np.save(buffer, prediction, allow_pickle=False)
+        return buffer.getvalue()
+    from sagemaker_inference import encoder
+    return encoder.encode(prediction, accept)
     
 if __name__ == '__main__':
     nn.DataParallel
@@ -132,6 +500,34 @@ if __name__ == '__main__':
     parser.add_argument('--num_epochs', type=int, default=10)    
     parser.add_argument('--learning_rate', type=float, default=0.003)
     parser.add_argument('--dropout_rate', type=float, default=0.0)
+    parser.add_argument('--model_width', type=int, default=32, help='Channels of the first conv layer')
+    parser.add_argument('--base_batch_size', type=int, default=16, help='Batch size learning_rate was tuned for')
+    parser.add_argument('--lr_scaling', type=str, default='none', choices=['none', 'linear', 'sqrt'],
+                        help='Scaling of learning_rate with batch_size / base_batch_size')
+    parser.add_argument('--shuffle', type=int, default=0, help='1: shuffles the training batches every epoch')
+    parser.add_argument('--num_workers', type=int, default=0, help='DataLoader processes reading the batches')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched by each DataLoader worker')
+    parser.add_argument('--pin_memory', type=int, default=1, help='1: pinned host batches, for async gpu transfers')
+    parser.add_argument('--precision', type=str, default='float32', choices=sorted(PRECISIONS.keys()),
+                        help='Autocast dtype of the training and of predict_fn. See benchmark.py')
+    parser.add_argument('--channels_last', type=int, default=0, help='1: channels last (NHWC) model and inputs')
+    parser.add_argument('--early_stopping_patience', type=int, default=0,
+                        help='Epochs without a test loss improvement before a fold stops. 0: disabled')
+    parser.add_argument('--early_stopping_min_delta', type=float, default=0.0,
+                        help='Min test loss decrease, since the last reset of the patience, counted as improvement. '
+                             'The best state still follows any decrease')
+    parser.add_argument('--threshold_percentile', type=float, default=99.0,
+                        help='Percentile of the validation reconstruction errors used as anomaly threshold')
+    parser.add_argument('--export_batch_size', type=int, default=1, help='Batch dim of the fixed batch ONNX export')
+    parser.add_argument('--variant_widths', type=str, default='', help='i.e. 0.5,0.25: variants retrained with fewer channels')
+    parser.add_argument('--variant_pruning', type=str, default='', help='i.e. 0.5: variants with pruned channels. See variants.py')
+    parser.add_argument('--variant_int8', type=int, default=0, help='1: static int8 quantized variants of each model')
+    parser.add_argument('--variant_finetune_epochs', type=int, default=2, help='Epochs of fine tuning after the pruning')
+    parser.add_argument('--variant_calibration_windows', type=int, default=1024, help='Training windows calibrating the int8 variants')
+    parser.add_argument('--variant_latency_threads', type=int, default=1, help='Threads of the latency measures (gateway cpu)')
+    parser.add_argument('--quantization_engine', type=str, default='', help='x86 (default) or qnnpack (arm gateways)')
+    parser.add_argument('--parallel_folds', type=int, default=1, help='Folds trained concurrently, each one in its own process')
+    parser.add_argument('--threads_per_fold', type=int, default=0, help='Torch threads of each fold process. 0: cores / parallel_folds')
 
     # Sagemaker specific arguments. Defaults are set in the environment variables.
     parser.add_argument('--output-data-dir', type=str, default=os.environ['SM_OUTPUT_DATA_DIR'])
@@ -140,4 +536,5 @@ if __name__ == '__main__':
     parser.add_argument('--num-gpus', type=int, default=os.environ['SM_NUM_GPUS'])
 
     args = parser.parse_args()
+    check_precision(args.precision)
     train(args)
@@ -1,5 +1,6 @@
 import boto3
 import logging
+import os
 import sagemaker
 from sagemaker.inputs import CreateModelInput, TrainingInput, TransformInput
 from sagemaker.model import Model
@@ -7,6 +8,8 @@ from sagemaker.pytorch.estimator import PyTorch
 from sagemaker.processing import ProcessingInput, ProcessingOutput
 from sagemaker.sklearn.processing import SKLearnProcessor
 from sagemaker.transformer import Transformer
+from sagemaker.workflow.execution_variables import ExecutionVariables
+from sagemaker.workflow.functions import Join
 from sagemaker.workflow.parameters import ParameterInteger, ParameterString
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.step_collections import RegisterModel
@@ -43,6 +46,131 @@ def get_session(
 
         raise e
 
+def get_execution_path(s3_bucket_name, output_files_path, name):
+    """
+    S3 prefix of an output of the current pipeline execution. The shards of a run differ
+    in number and names, so the shards of previous runs must not share their prefix
+    """
+    return Join(on='/', values=[
+        's3://{}/{}/{}'.format(s3_bucket_name, output_files_path, name),
+        ExecutionVariables.PIPELINE_EXECUTION_ID
+    ])
+
+def get_sharded_preprocessing_steps(
+        processor,
+        merge_processor,
+        code,
+        input_data,
+        s3_bucket_name,
+        output_files_path,
+        job_arguments=[],
+        library_inputs=[]):
+    """
+    Preprocessing distributed across ProcessingInstanceCount instances.
+    The input files are sharded by S3 key, so each instance only processes its part:
+        1. partial-stats: quat -> euler features + raw statistics of each shard
+        2. denoise: merges the raw statistics, denoises each shard + its statistics
+        3. merge-stats: lightweight single instance step, exports the global statistics
+        4. transform: normalizes and windows each shard with the global statistics
+    The intermediate files, the shards and the manifest are kept under prefixes of the
+    pipeline execution.
+    library_inputs are mounted in every step (i.e. the shared signal processing and arrow format modules).
+    """
+    def work_path(name):
+        return Join(on='/', values=[
+            's3://{}/{}/work'.format(s3_bucket_name, output_files_path),
+            ExecutionVariables.PIPELINE_EXECUTION_ID,
+            name
+        ])
+
+    step_partial_stats = ProcessingStep(
+        name="WindTurbineDataPartialStats",
+        code=code,
+        processor=processor,
+        inputs=[
+            ProcessingInput(source=input_data, destination='/opt/ml/processing/input',
+                            s3_data_distribution_type='ShardedByS3Key')
+        ] + library_inputs,
+        outputs=[
+            ProcessingOutput(output_name='features', source='/opt/ml/processing/features',
+                             destination=work_path('features')),
+            ProcessingOutput(output_name='raw_stats', source='/opt/ml/processing/raw_stats',
+                             destination=work_path('raw_stats'))
+        ],
+        job_arguments=['--mode', 'partial-stats'] + job_arguments
+    )
+
+    step_denoise = ProcessingStep(
+        name="WindTurbineDataDenoise",
+        code=code,
+        processor=processor,
+        inputs=[
+            ProcessingInput(
+                source=step_partial_stats.properties.ProcessingOutputConfig.Outputs["features"].S3Output.S3Uri,
+                destination='/opt/ml/processing/features',
+                s3_data_distribution_type='ShardedByS3Key'),
+            ProcessingInput(
+                source=step_partial_stats.properties.ProcessingOutputConfig.Outputs["raw_stats"].S3Output.S3Uri,
+                destination='/opt/ml/processing/raw_stats')
+        ] + library_inputs,
+        outputs=[
+            ProcessingOutput(output_name='denoised', source='/opt/ml/processing/denoised',
+                             destination=work_path('denoised')),
+            ProcessingOutput(output_name='denoised_stats', source='/opt/ml/processing/denoised_stats',
+                             destination=work_path('denoised_stats'))
+        ],
+        job_arguments=['--mode', 'denoise'] + job_arguments
+    )
+
+    step_merge_stats = ProcessingStep(
+        name="WindTurbineDataMergeStats",
+        code=code,
+        processor=merge_processor,
+        inputs=[
+            ProcessingInput(
+                source=step_partial_stats.properties.ProcessingOutputConfig.Outputs["raw_stats"].S3Output.S3Uri,
+                destination='/opt/ml/processing/raw_stats'),
+            ProcessingInput(
+                source=step_denoise.properties.ProcessingOutputConfig.Outputs["denoised_stats"].S3Output.S3Uri,
+                destination='/opt/ml/processing/denoised_stats')
+        ] + library_inputs,
+        outputs=[
+            ProcessingOutput(
+                output_name='statistics',
+                source='/opt/ml/processing/statistics',
+                destination='s3://{}/{}/statistics'.format(s3_bucket_name, output_files_path))
+        ],
+        job_arguments=['--mode', 'merge-stats'] + job_arguments
+    )
+
+    step_transform = ProcessingStep(
+        name="WindTurbineDataPreprocess",
+        code=code,
+        processor=processor,
+        inputs=[
+            ProcessingInput(
+                source=step_denoise.properties.ProcessingOutputConfig.Outputs["denoised"].S3Output.S3Uri,
+                destination='/opt/ml/processing/denoised',
+                s3_data_distribution_type='ShardedByS3Key'),
+            ProcessingInput(
+                source=step_merge_stats.properties.ProcessingOutputConfig.Outputs["statistics"].S3Output.S3Uri,
+                destination='/opt/ml/processing/statistics')
+        ] + library_inputs,
+        outputs=[
+            ProcessingOutput(
+                output_name='train_data',
+                source='/opt/ml/processing/train',
+                destination=get_execution_path(s3_bucket_name, output_files_path, 'train_data')),
+            ProcessingOutput(
+                output_name='manifest',
+                source='/opt/ml/processing/manifest',
+                destination=get_execution_path(s3_bucket_name, output_files_path, 'manifest'))
+        ],
+        job_arguments=['--mode', 'transform'] + job_arguments
+    )
+
+    return [step_partial_stats, step_denoise, step_merge_stats, step_transform]
+
 def get_pipeline(
     region,
     model_package_group_name,
@@ -62,6 +190,9 @@ def get_pipeline(
     s3_bucket_name,
     training_hyperparameters={},
     training_metrics=[],
+    preprocessing_sharded=False,
+    preprocessing_output_format='npy',
+    transform_output='reconstruction',
     role=None,
     pipeline_name="TrainingPipeline"):
 
@@ -134,32 +265,73 @@ def get_pipeline(
         max_runtime_in_seconds=7200,
     )
 
-    step_process = ProcessingStep(
-        name="WindTurbineDataPreprocess",
-        code=preprocessing_entrypoint,
-        processor=script_processor,
-        inputs=[
-            ProcessingInput(source=input_data, destination='/opt/ml/processing/input')
-        ],
-        outputs=[
-            ProcessingOutput(
-                output_name='train_data',
-                source='/opt/ml/processing/train',
-                destination='s3://{}/{}/train_data'.format(s3_bucket_name, postprocessing_output_files_path)),
-            ProcessingOutput(
-                output_name='statistics',
-                source='/opt/ml/processing/statistics',
-                destination='s3://{}/{}/statistics'.format(s3_bucket_name, postprocessing_output_files_path))
-        ],
-        job_arguments=['--num-dataset-splits', '20']
-    )
+    ## the features of each input file are cached by content hash, so a run only converts the new files
+    preprocessing_arguments = [
+        '--shard-size-mb', '5',
+        '--cache-uri', 's3://{}/{}/cache'.format(s3_bucket_name, postprocessing_output_files_path),
+        '--output-format', preprocessing_output_format
+    ]
+    # arrow: compressed columnar shards, decoded by the input_fn of the training script
+    train_data_content_type = 'application/vnd.apache.arrow.file' if preprocessing_output_format == 'arrow' else 'application/x-npy'
+
+    # the modules next to the entrypoint: signal_processing.py (shared with the edge)
+    # and arrow_format.py (the arrow shards format, shared with training)
+    library_dir = os.path.dirname(preprocessing_entrypoint)
+    library_inputs = [ProcessingInput(source=library_dir, destination='/opt/ml/processing/lib')]
+
+    if preprocessing_sharded:
+        preprocessing_steps = get_sharded_preprocessing_steps(
+            script_processor,
+            SKLearnProcessor(
+                framework_version=preprocessing_framework_version,
+                role=role,
+                instance_type=preprocessing_instance_type,
+                instance_count=1,
+                max_runtime_in_seconds=7200,
+            ),
+            preprocessing_entrypoint,
+            input_data,
+            s3_bucket_name,
+            postprocessing_output_files_path,
+            job_arguments=preprocessing_arguments,
+            library_inputs=library_inputs
+        )
+    else:
+        preprocessing_steps = [ProcessingStep(
+            name="WindTurbineDataPreprocess",
+            code=preprocessing_entrypoint,
+            processor=script_processor,
+            inputs=[
+                ProcessingInput(source=input_data, destination='/opt/ml/processing/input')
+            ] + library_inputs,
+            outputs=[
+                ProcessingOutput(
+                    output_name='train_data',
+                    source='/opt/ml/processing/train',
+                    destination=get_execution_path(s3_bucket_name, postprocessing_output_files_path, 'train_data')),
+                ProcessingOutput(
+                    output_name='statistics',
+                    source='/opt/ml/processing/statistics',
+                    destination='s3://{}/{}/statistics'.format(s3_bucket_name, postprocessing_output_files_path)),
+                ProcessingOutput(
+                    output_name='manifest',
+                    source='/opt/ml/processing/manifest',
+                    destination=get_execution_path(s3_bucket_name, postprocessing_output_files_path, 'manifest'))
+            ],
+            job_arguments=preprocessing_arguments
+        )]
+    # the step that produces the train_data output
+    step_process = preprocessing_steps[-1]
 
     """
         Training Step
     """
 
     estimator = PyTorch(
-        training_entrypoint,
+        os.path.basename(training_entrypoint),
+        # the helper modules next to the entrypoint (variants.py, hpo.py) are uploaded too
+        source_dir=os.path.dirname(training_entrypoint),
+        dependencies=[os.path.join(library_dir, 'arrow_format.py')],
         framework_version=training_framework_version,
         role=role,
         sagemaker_session=sagemaker_session,
@@ -176,7 +348,7 @@ def get_pipeline(
         estimator=estimator,
         inputs={"train": TrainingInput(
             s3_data=step_process.properties.ProcessingOutputConfig.Outputs["train_data"].S3Output.S3Uri,
-            content_type="application/x-npy"
+            content_type=train_data_content_type
         )},
         cache_config=cache_config
     )
@@ -211,6 +383,8 @@ def get_pipeline(
             image_scope='inference'
         ),
         model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+        # reconstruction, errors or anomalies: see predict_fn in wind_turbine.py
+        env={'TRANSFORM_OUTPUT': transform_output},
         sagemaker_session=sagemaker_session,
         role=role
     )
@@ -237,7 +411,7 @@ def get_pipeline(
         ),
         inputs=TransformInput(
             data=step_process.properties.ProcessingOutputConfig.Outputs["train_data"].S3Output.S3Uri,
-            content_type="application/x-npy")
+            content_type=train_data_content_type)
     )
 
     pipeline = Pipeline(
@@ -254,8 +428,7 @@ def get_pipeline(
             model_approval_status,
             model_package_group_name
         ],
-        steps=[
-            step_process,
+        steps=preprocessing_steps + [
             step_train,
             step_register_model,
             step_create_model,
@@ -78,7 +78,8 @@ class EdgeAgentClient(object):
                 tensor.shared_memory_handle.offset = 0
                 tensor.shared_memory_handle.segment_id = x
             else:
-                tensor.byte_data = x.astype(np.float32).tobytes()
+                # no intermediate copy when x is already a contiguous float32 array
+                tensor.byte_data = np.ascontiguousarray(x, dtype=np.float32).tobytes()
 
             req.tensors.append(tensor)
 
@@ -14,6 +14,7 @@ class MessagingClient():
         self.turbine_update_label_topic = f'wind-turbine/{turbine_id}/label/update'
         self.turbine_anomalies_topic = f'wind-turbine/{turbine_id}/anomalies'
         self.turbine_raw_data_topic = f'wind-turbine/{turbine_id}/raw-data'
+        self.turbine_metrics_topic = f'wind-turbine/{turbine_id}/metrics'
 
 
     def subscribe_to_data(self, handler):
@@ -42,6 +43,12 @@ class MessagingClient():
                 message=bytes(json_message, 'utf-8'),
                 qos=QOS.AT_LEAST_ONCE)
 
+    def publish_metrics(self, message):
+        json_message = json.dumps(message)
+        ggv2.publish(topic=self.turbine_metrics_topic,
+                message=bytes(json_message, 'utf-8'),
+                qos=QOS.AT_MOST_ONCE)
+
 
 
     
@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+"""
+Latency instrumentation for the detection pipeline.
+Each stage (ingest, euler, denoise, ...) is timed into a fixed-bucket histogram.
+The summary is published periodically on a metrics topic and can be pulled
+from a local HTTP endpoint (GET /metrics).
+The histograms cover one publish interval: they are reset each time the summary is
+published, so the percentiles are the ones of the last interval. The counters are cumulative.
+"""
+
+# upper bounds of the histogram buckets, in milliseconds
+DEFAULT_BUCKETS_MS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """ Fixed-bucket histogram of durations in milliseconds """
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        # the last slot counts the values above the greatest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value_ms):
+        idx = len(self.buckets)
+        for i, upper in enumerate(self.buckets):
+            if value_ms <= upper:
+                idx = i
+                break
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value_ms
+        self.min = value_ms if self.min is None else min(self.min, value_ms)
+        self.max = value_ms if self.max is None else max(self.max, value_ms)
+
+    def percentile(self, q):
+        """
+        Approximates the q-th percentile (0-100) by interpolating
+        linearly inside the bucket where it falls
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        lower = 0.0
+        for i, c in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if c > 0 and seen + c >= rank:
+                value = lower + (upper - lower) * (rank - seen) / c
+                return min(max(value, self.min), self.max)
+            seen += c
+            lower = upper
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count > 0 else None,
+            "min_ms": self.min,
+            "max_ms": self.max,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": {
+                **{str(b): c for b, c in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1]
+            }
+        }
+
+
+class MetricsRegistry(object):
+    """ Thread-safe collection of named histograms and counters """
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.interval_start = time.time()
+
+    def observe(self, name, value_ms):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.buckets)
+            self.histograms[name].observe(value_ms)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times the enclosed block and records it under `name`
+
+            with metrics.timer('denoise'):
+                ...
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start_time) * 1000.0)
+
+    def summary(self, reset=False):
+        """
+        Summary of the histograms since the last reset. With reset=True the histograms
+        are reset in the same lock, so no observation is lost between the two
+        """
+        with self.lock:
+            summary = {
+                "timestamp": time.time(),
+                "interval_start": self.interval_start,
+                "stages": {k: h.summary() for k, h in self.histograms.items()},
+                "counters": dict(self.counters)
+            }
+            if reset:
+                self.__reset__()
+            return summary
+
+    def reset(self):
+        with self.lock:
+            self.__reset__()
+
+    def __reset__(self):
+        for h in self.histograms.values(): h.reset()
+        self.interval_start = time.time()
+
+
+class MetricsExporter(object):
+    """
+    Exports the summary of a MetricsRegistry:
+        - periodically, through a publish callback (i.e. MQTT metrics topic), resetting the histograms
+        - on demand, through a local HTTP endpoint (GET /metrics): the current interval so far
+    """
+    def __init__(self, registry, publish_fn=None, interval=60, port=None, host='127.0.0.1'):
+        self.registry = registry
+        self.publish_fn = publish_fn
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self.running = False
+        self.server = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.publish_fn is not None and self.interval > 0:
+            self.publishing = threading.Thread(target=self.__publish_forever__, daemon=True)
+            self.publishing.start()
+        if self.port is not None:
+            self.server = HTTPServer((self.host, self.port), self.__handler_class__())
+            self.serving = threading.Thread(target=self.server.serve_forever, daemon=True)
+            self.serving.start()
+            logging.info("Metrics endpoint listening on http://%s:%d/metrics" % (self.host, self.port))
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __publish_forever__(self):
+        while self.running:
+            time.sleep(self.interval)
+            if not self.running:
+                break
+            try:
+                # each published summary covers one interval
+                self.publish_fn(self.registry.summary(reset=True))
+            except Exception as e:
+                logging.error("Error publishing metrics: %s" % e)
+
+    def __handler_class__(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = bytes(json.dumps(registry.summary()), 'utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        return MetricsHandler
@@ -0,0 +1,120 @@
+import argparse
+import math
+import os
+import time
+import tracemalloc
+import numpy as np
+import pywt
+from signal_processing import WindowPreprocessor
+
+"""
+Fused float32 preprocessing of the turbine samples on the edge.
+WindowPreprocessor (see signal_processing) does the same work as euler_from_quaternion ->
+wavelet_denoise -> normalization -> create_dataset, in float32. The work buffers are
+preallocated from TIME_STEPS, STEP and n_features, so each window only
+allocates the temporary arrays created inside pywt.
+
+Run this file to benchmark it against the original (float64, per-sample) path:
+    python3 preprocessor.py --iterations 200
+"""
+
+
+# The original detector path (util.py + windturbine.py of the first release), frozen here as the
+# baseline of the benchmark: it must not use the optimized helpers of signal_processing
+
+def reference_euler_from_quaternion(x, y, z, w):
+    """ Quaternion -> euler angles (roll, pitch, yaw) of one sample, in radians """
+    t0 = +2.0 * (w * x + y * z)
+    t1 = +1.0 - 2.0 * (x * x + y * y)
+    roll_x = math.atan2(t0, t1)
+
+    t2 = +2.0 * (w * y - z * x)
+    t2 = +1.0 if t2 > +1.0 else t2
+    t2 = -1.0 if t2 < -1.0 else t2
+    pitch_y = math.asin(t2)
+
+    t3 = +2.0 * (w * z + x * y)
+    t4 = +1.0 - 2.0 * (y * y + z * z)
+    yaw_z = math.atan2(t3, t4)
+
+    return roll_x, pitch_y, yaw_z
+
+
+def reference_wavelet_denoise(data, wavelet, noise_sigma):
+    wavelet = pywt.Wavelet(wavelet)
+    levels  = min(5, (np.floor(np.log2(data.shape[0]))).astype(int))
+    wavelet_coeffs = pywt.wavedec(data, wavelet, level=levels)
+    threshold = noise_sigma*np.sqrt(2*np.log2(data.size))
+    new_wavelet_coeffs = map(lambda x: pywt.threshold(x, threshold, mode='soft'), wavelet_coeffs)
+    return pywt.waverec(list(new_wavelet_coeffs), wavelet)
+
+
+def reference_create_dataset(X, time_steps=1, step=1):
+    Xs = []
+    for i in range(0, len(X) - time_steps, step):
+        v = X[i:(i + time_steps)]
+        Xs.append(v)
+    return np.array(Xs)
+
+
+def reference_preprocess(buffer, raw_std, mean, std, time_steps, step, n_features=6):
+    """
+    The original detector path (windturbine.__data_prep__ + __preprocess_data__), per sample in float64
+    """
+    new_buffer = []
+    for data in np.array(buffer):
+        roll, pitch, yaw = reference_euler_from_quaternion(data[0], data[1], data[2], data[3])
+        new_buffer.append([roll, pitch, yaw, data[4], data[5], data[6]])
+    data = np.array(new_buffer)
+    data = np.array([reference_wavelet_denoise(data[:,i], 'db6', raw_std[i]) for i in range(n_features)])
+    data = data.transpose((1,0))
+    data -= mean
+    data /= std
+    data = data[-(time_steps+step):]
+    x = reference_create_dataset(data, time_steps, step)
+    x = np.transpose(x, (0, 2, 1)).reshape(x.shape[0], n_features, 10, 10)
+    return x.astype(np.float32)
+
+
+def benchmark(fn, buffers, iterations):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for i in range(iterations):
+        fn(buffers[i % len(buffers)])
+    elapsed_time = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed_time / iterations * 1000.0, peak / 1024.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--num-samples', type=int, default=500)
+    parser.add_argument('--statistics', type=str, default=os.path.join(os.path.dirname(__file__), '../statistics'))
+    args = parser.parse_args()
+
+    raw_std = np.load(os.path.join(args.statistics, 'raw_std.npy'))
+    mean = np.load(os.path.join(args.statistics, 'mean.npy'))
+    std = np.load(os.path.join(args.statistics, 'std.npy'))
+    TIME_STEPS, STEP = 100, 10
+
+    # synthetic turbine samples: unit quaternions + wind speed, rps and voltage
+    rng = np.random.RandomState(42)
+    buffers = []
+    for _ in range(8):
+        q = rng.normal(size=(args.num_samples, 4))
+        q /= np.linalg.norm(q, axis=1, keepdims=True)
+        other = rng.uniform([0, 0, 0], [10, 10, 300], size=(args.num_samples, 3))
+        buffers.append(list(np.hstack([q, other])))
+
+    fused = WindowPreprocessor(raw_std, mean, std, TIME_STEPS, STEP, num_samples=args.num_samples)
+    reference = lambda b: reference_preprocess(b, raw_std, mean, std, TIME_STEPS, STEP)
+
+    ref_ms, ref_kb = benchmark(reference, buffers, args.iterations)
+    fused_ms, fused_kb = benchmark(fused, buffers, args.iterations)
+    max_diff = max(np.abs(fused(b) - reference(b)).max() for b in buffers)
+
+    print("reference: %.3f ms/window; peak %.1f KiB" % (ref_ms, ref_kb))
+    print("fused:     %.3f ms/window; peak %.1f KiB" % (fused_ms, fused_kb))
+    print("speedup: %.2fx; max abs diff: %.2e" % (ref_ms / fused_ms, max_diff))
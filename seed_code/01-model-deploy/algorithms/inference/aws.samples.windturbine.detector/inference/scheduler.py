@@ -0,0 +1,174 @@
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Rate-controlled scheduling for the anomaly detection.
+It replaces the fixed sleep at the end of each detection: the pacing happens
+before a run, never inside the subscription handlers, and a run longer
+than the target cadence is counted as an overrun instead of crashing.
+The fleet simulator uses an identical copy of the detector's file, checked by
+00-model-build-train/algorithms/preprocessing/benchmark.py (EDGE_SHARED_MODULES).
+"""
+
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+POLICIES = (SKIP, CATCH_UP)
+
+
+class RateScheduler(object):
+    """
+    Paces a loop at a target cadence: one slot every `interval` seconds.
+    When a run takes longer than the interval (overrun) the next slots are already late:
+        - skip: late slots are dropped and the schedule is realigned to the next slot
+        - catch_up: late slots run back-to-back (at most `max_catch_up`) until the schedule is recovered
+    An interval of 0 disables the pacing.
+
+        scheduler = RateScheduler(0.5)
+        while running:
+            scheduler.wait()
+            with scheduler.run():
+                ...
+    """
+    def __init__(self, interval=0.5, policy=SKIP, max_catch_up=10):
+        if policy not in POLICIES:
+            raise Exception("Invalid scheduling policy '%s'. Use one of %s" % (policy, POLICIES))
+        self.interval = max(0.0, interval)
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.next_run = None
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def wait(self, stop_event=None):
+        """
+        Blocks until the next slot is due.
+        Returns False if the stop_event was set while waiting
+        """
+        now = time.monotonic()
+        if self.next_run is None:
+            self.next_run = now
+        delay = self.next_run - now
+        if delay > 0:
+            if stop_event is not None:
+                return not stop_event.wait(delay)
+            time.sleep(delay)
+        return True
+
+    @contextmanager
+    def run(self):
+        """ Measures the enclosed run and schedules the next slot """
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.__completed__(start_time, time.monotonic())
+
+    def __completed__(self, start_time, end_time):
+        self.runs += 1
+        elapsed_time = end_time - start_time
+        if self.next_run is None:
+            self.next_run = start_time
+
+        if self.interval == 0:
+            self.next_run = end_time
+            return
+
+        if elapsed_time > self.interval:
+            self.overruns += 1
+            logging.warning("Detection overrun: %.3fs > %.3fs" % (elapsed_time, self.interval))
+
+        self.next_run += self.interval
+        if end_time <= self.next_run:
+            return
+        missed = int((end_time - self.next_run) // self.interval)
+        if self.policy == SKIP:
+            # realign to the first slot after the end of this run
+            self.skipped += missed + 1
+            self.next_run += (missed + 1) * self.interval
+        elif missed > self.max_catch_up:
+            self.skipped += missed - self.max_catch_up
+            self.next_run += (missed - self.max_catch_up) * self.interval
+
+
+class DetectionWorker(object):
+    """
+    Runs `target(*args)` in a dedicated thread for each submitted window,
+    paced by a RateScheduler. The subscription handlers only enqueue the window,
+    so they never block and a slow or failing window never raises in them.
+        - skip: only the newest pending window is processed, the older ones are dropped
+        - catch_up: the pending windows are processed in order (at most `max_pending` are kept)
+    """
+    def __init__(self, target, interval=0.5, policy=SKIP, max_pending=10, metrics=None):
+        self.target = target
+        self.scheduler = RateScheduler(interval, policy, max_catch_up=max_pending)
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.running = False
+        self.dropped = 0
+        self.errors = 0
+
+    def submit(self, *args):
+        with self.condition:
+            self.pending.append(args)
+            if len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.__count__('dropped', 'detection_dropped')
+            self.condition.notify()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.stop_event.clear()
+        self.processing = threading.Thread(target=self.__run__, daemon=True)
+        self.processing.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.processing is not threading.current_thread():
+            self.processing.join()
+
+    def __count__(self, attr, counter, value=1):
+        setattr(self, attr, getattr(self, attr) + value)
+        if self.metrics is not None and value > 0:
+            self.metrics.increment(counter, value)
+
+    def __run__(self):
+        while self.running:
+            with self.condition:
+                while self.running and len(self.pending) == 0:
+                    self.condition.wait(0.5)
+            if not self.running or not self.scheduler.wait(self.stop_event):
+                break
+
+            with self.condition:
+                if len(self.pending) == 0:
+                    continue
+                if self.scheduler.policy == SKIP:
+                    args = self.pending.pop()
+                    self.__count__('dropped', 'detection_dropped', len(self.pending))
+                    self.pending.clear()
+                else:
+                    args = self.pending.popleft()
+
+            overruns = self.scheduler.overruns
+            try:
+                with self.scheduler.run():
+                    self.target(*args)
+            except Exception as e:
+                logging.exception(e)
+                self.__count__('errors', 'detection_errors')
+            if self.metrics is not None and self.scheduler.overruns > overruns:
+                self.metrics.increment('detection_overruns', self.scheduler.overruns - overruns)
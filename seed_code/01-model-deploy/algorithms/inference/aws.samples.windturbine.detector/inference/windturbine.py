@@ -6,7 +6,10 @@ import json
 import sys
 import typing
 from edgeagentclient import EdgeAgentClient
-import util
+from metrics import MetricsRegistry, MetricsExporter
+from scheduler import DetectionWorker
+from scoring import AnomalyScorer
+from signal_processing import WindowPreprocessor
 import messaging_client as msg_client
 import os
 
@@ -20,14 +23,30 @@ class WindTurbine(object):
         - Launch a Edge Agent Client that integrates the Wind Turbine with the Edge Device
     """
     # extra args model_path, model_name, model_version
-    def __init__(self, turbine_id, agent_socket):
+    def __init__(self, turbine_id, agent_socket, metrics_interval=60, metrics_port=None,
+                 detection_interval=0.5, detection_policy='skip', anomaly_score='mae', ewma_alpha=0.3):
         if turbine_id is None:
             raise Exception("You need to pass the turbine id as argument")
         
         self.running = False
         self.tentative = 0
+        self.anomaly_score = anomaly_score
+        self.ewma_alpha = ewma_alpha
 
         self.msg_client = msg_client.MessagingClient(turbine_id)
+
+        ## per-stage latency histograms, published on the metrics topic and served locally
+        self.metrics = MetricsRegistry()
+        self.metrics_exporter = MetricsExporter(self.metrics, self.msg_client.publish_metrics,
+            interval=metrics_interval, port=metrics_port)
+        self.metrics_exporter.start()
+
+        ## the detection runs in its own thread, paced at the target cadence
+        self.buffer_lock = threading.Lock()
+        self.detection_worker = DetectionWorker(self.__detect_anomalies__,
+            interval=detection_interval, policy=detection_policy, metrics=self.metrics)
+        self.detection_worker.start()
+
         self.msg_client.subscribe_to_data(self.__data_handler__)
 
         ## launch edge agent client
@@ -52,35 +71,46 @@ class WindTurbine(object):
             "qw": -0.1,
             "wind speed rps": 2.06,
             "rps": 2.19,
-            "voltage": 70
+            "voltage": 70,
+            "ts": 1634567890.123
         }
+
+        "ts" is the epoch time (seconds) when the simulator emitted the sample.
+        It is optional and it is used to measure the emit-to-alert latency.
         """
-        json_response = json.loads(payload)
-        raw_data = np.array(list(json_response.values()))
-        self.acc_buffer.append(raw_data)
-        self.dashboard_buffer.append(raw_data.tolist())
-        if len(self.acc_buffer) >= self.min_num_samples:
-            logging.info("Got enough samples - detecting anomalies")
-            new_buf = self.acc_buffer.copy()
+        with self.metrics.timer('ingest'):
+            json_response = json.loads(payload)
+            sample_ts = json_response.pop('ts', None)
+            raw_data = np.array(list(json_response.values()))
+        with self.buffer_lock:
+            self.acc_buffer.append(raw_data)
+            self.dashboard_buffer.append(raw_data.tolist())
+            if sample_ts is not None:
+                self.last_sample_ts = sample_ts
+            if len(self.acc_buffer) < self.min_num_samples:
+                return
+            new_buf = self.acc_buffer
+            dashboard_buf = self.dashboard_buffer
             self.acc_buffer = []
-            
-            # update the dashboard of simulator
-            self.msg_client.publish_data(self.dashboard_buffer)
             self.dashboard_buffer = []
-            
-            self.__detect_anomalies__(new_buf)
+            last_sample_ts = self.last_sample_ts
+
+        logging.info("Got enough samples - detecting anomalies")
+        # update the dashboard of simulator
+        self.msg_client.publish_data(dashboard_buf)
+
+        # hand the window over to the detection thread
+        self.detection_worker.submit(new_buf, last_sample_ts)
 
             
-    def __detect_anomalies__(self, buffer):     
+    def __detect_anomalies__(self, buffer, sample_ts=None):     
         """
         Process the data received from the turbine and reports the 
-        anomalies detected via MQTT
+        anomalies detected via MQTT.
+        sample_ts is the emit time of the most recent sample of the buffer
         """
         
         start_time = time.time()
-
-        # create a copy & prep the data
-        data = self.__data_prep__(np.array(buffer))
         
         if not self.edge_agent.is_model_loaded(self.model_meta['model_name']):
             model_label_data = {"model_label_status" : "Model not loaded"}
@@ -91,63 +121,30 @@ class WindTurbine(object):
                 self.msg_client.publish_model_status({"model_label_status" : "Model loaded"})
                 self.model_status_published = True
 
-        x = self.__preprocess_data__(data)
+        # prep the data: euler, denoise, normalize and windowing in float32
+        x = self.preprocessor(buffer)
         # run the model                    
-        p = self.edge_agent.predict(self.model_meta['model_name'], x)
+        with self.metrics.timer('predict'):
+            p = self.edge_agent.predict(self.model_meta['model_name'], x)
         
         if p is not None:
-            values, anomalies = self.__calculate_anomalies__(x, p)
-            anomaly_result = {"values" : values.tolist(), "anomalies" : anomalies.tolist()} 
-            self.msg_client.publish_anomalies(message=anomaly_result)   
+            with self.metrics.timer('anomaly'):
+                values, anomalies = self.__calculate_anomalies__(x, p)
+            anomaly_result = {"values" : values.tolist(), "anomalies" : anomalies.tolist(), "ts": sample_ts} 
+            with self.metrics.timer('publish'):
+                self.msg_client.publish_anomalies(message=anomaly_result)   
+            if sample_ts is not None:
+                self.metrics.observe('emit_to_alert', (time.time() - sample_ts) * 1000.0)
         else:
             logging.info(f"No anomalies detected")
 
         elapsed_time = time.time() - start_time
-        time.sleep(0.5-elapsed_time)
-
+        self.metrics.observe('detection', elapsed_time * 1000.0)
 
-    def __data_prep__(self, buffer):
-        """
-        This method is called for each reading.
-        Here we do some data prep and accumulate the data in the buffer
-        for denoising
-        """
 
-        # We already receive the the necessary data so, remove the feature_ids mappings and use the indexes directly
-        new_buffer = []
-        for data in buffer:
-            roll,pitch,yaw = util.euler_from_quaternion(
-                data[0],data[1],
-                data[2],data[3]
-            )
-            row = [roll,pitch,yaw, data[4],data[5], data[6]]
-            new_buffer.append(row)
-        return np.array(new_buffer)        
-
-
-
-    def __preprocess_data__(self, data):
-        # denoise
-        data = np.array([util.wavelet_denoise(data[:,i], 'db6', self.raw_std[i]) for i in range(self.n_features)])
-        data = data.transpose((1,0))
-        # normalize                     
-        data -= self.mean
-        data /= self.std
-        data = data[-(self.TIME_STEPS+self.STEP):]
-        # create the dataset and reshape it
-        x = util.create_dataset(data, self.TIME_STEPS, self.STEP)                    
-        x = np.transpose(x, (0, 2, 1)).reshape(x.shape[0], self.n_features, 10, 10)
-        return x
-    
-    
     def __calculate_anomalies__(self, x, p):
-        a = x.reshape(x.shape[0], self.n_features, 100).transpose((0,2,1))
-        b = p.reshape(p.shape[0], self.n_features, 100).transpose((0,2,1))
         # check the anomalies
-        pred_mae_loss = np.mean(np.abs(b - a), axis=1).transpose((1,0))
-        values = np.mean(pred_mae_loss, axis=1)
-        anomalies = (values > self.thresholds)
-        return values, anomalies   
+        return self.scorer.score(x, p)
 
     def load_model(self,  model_path, model_name):
         logging.info("windturbine:load_model {} - {}".format(model_path, model_name))
@@ -159,6 +156,7 @@ class WindTurbine(object):
 
         self.acc_buffer = []
         self.dashboard_buffer = []
+        self.last_sample_ts = None
         self.model_loaded = False
 
         self.resp = self.edge_agent.load_model(model_name, model_path)
@@ -182,6 +180,7 @@ class WindTurbine(object):
         # then we load the thresholds computed in the training notebook
         # for more info, take a look on the Notebook #2
         self.thresholds = np.load(os.path.join(file_path, '../statistics/thresholds.npy'))
+        self.scorer = AnomalyScorer(self.thresholds, method=self.anomaly_score, alpha=self.ewma_alpha)
 
         # configurations to format the time based data for the anomaly detection model
         # If you change these parameters you need to retrain your model with the new parameters
@@ -196,6 +195,10 @@ class WindTurbine(object):
         # minimal buffer length for denoising. We need to accumulate some sample before denoising
         self.min_num_samples = 500
 
+        # preprocessing pipeline with work buffers sized for these parameters
+        self.preprocessor = WindowPreprocessor(self.raw_std, self.mean, self.std,
+            self.TIME_STEPS, self.STEP, self.n_features, self.min_num_samples, metrics=self.metrics)
+
         return True
 
     def unload_model(self, model_name):
@@ -221,3 +224,5 @@ class WindTurbine(object):
         """
         logging.info("Destroying the application")
         self.running = False
+        self.detection_worker.stop()
+        self.metrics_exporter.stop()
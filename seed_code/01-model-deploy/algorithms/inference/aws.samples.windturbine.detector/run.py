@@ -19,6 +19,12 @@ if __name__ == "__main__":
     
     parser.add_argument('--agent-socket', type=str, default="/tmp/edge_agent", help='The unix socket path created by the agent')
     parser.add_argument('--model-path', type=str, default='models', help='Absolute path to the model dir')
+    parser.add_argument('--metrics-interval', type=int, default=60, help='Seconds between two metrics summaries published on the metrics topic')
+    parser.add_argument('--detection-interval', type=float, default=0.5, help='Target cadence (seconds) of the anomaly detection. 0 disables the pacing')
+    parser.add_argument('--detection-policy', type=str, default='skip', choices=['skip', 'catch_up'], help='What to do with the windows received while the detection is late')
+    parser.add_argument('--anomaly-score', type=str, default='mae', choices=['mae', 'max', 'ewma'], help='Score compared with the thresholds: mean, max-window or ewma-smoothed reconstruction error')
+    parser.add_argument('--ewma-alpha', type=float, default=0.3, help='Smoothing factor of the ewma anomaly score')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Local port of the metrics pull endpoint (GET /metrics). Disabled if not set')
     
     device_name = os.environ['AWS_IOT_THING_NAME']
     
@@ -31,7 +37,8 @@ if __name__ == "__main__":
     turbine_id = device_name[-1]
     log.info(f"Initializing the inference component for {device_name} which is turbine [{turbine_id}]")
 
-    turbine = WindTurbine(turbine_id, args.agent_socket)
+    turbine = WindTurbine(turbine_id, args.agent_socket, args.metrics_interval, args.metrics_port,
+        args.detection_interval, args.detection_policy, args.anomaly_score, args.ewma_alpha)
 
     response = turbine.load_model(args.model_path, 'detector')
 
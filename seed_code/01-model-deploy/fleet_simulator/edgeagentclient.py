@@ -87,6 +87,37 @@ class EdgeAgentClient(object):
             logging.error(e)
             return None
 
+    def predict_batch(self, model_name, x):
+        """
+        Invokes the model for a batch of inputs. If the model was compiled
+        for a fixed batch size, the batch is split in chunks of that size
+        (the last one is padded with zeros)
+        """
+        if self.model_map.get(model_name) is None:
+            logging.error('Model %s not loaded' % model_name)
+            return None
+        batch_size = self.get_batch_size(model_name)
+        if batch_size <= 0 or batch_size == x.shape[0]:
+            return self.predict(model_name, x)
+
+        preds = []
+        for i in range(0, x.shape[0], batch_size):
+            chunk = x[i:i + batch_size]
+            n = chunk.shape[0]
+            if n < batch_size:
+                chunk = np.concatenate([chunk, np.zeros((batch_size - n,) + chunk.shape[1:], dtype=chunk.dtype)])
+            p = self.predict(model_name, chunk)
+            if p is None:
+                return None
+            preds.append(p[:n])
+        return np.concatenate(preds)
+
+    def get_batch_size(self, model_name):
+        """ Batch dim the model was compiled for (<= 0: dynamic) or None if not loaded """
+        if self.model_map.get(model_name) is None:
+            return None
+        return self.model_map[model_name]['in'][0].shape[0]
+
     def is_model_loaded(self, model_name):
         return self.model_map.get(model_name) is not None
     
@@ -0,0 +1,93 @@
+import numpy as np
+
+"""
+Anomaly scoring of the autoencoder reconstructions.
+It works straight on the model layout (..., N, n_features, 10, 10), so
+several turbines can be scored at once with a leading turbine axis.
+The fleet simulator scores with an identical copy of the detector's file, checked by
+00-model-build-train/algorithms/preprocessing/benchmark.py (EDGE_SHARED_MODULES).
+"""
+
+MAE = 'mae'
+MAX = 'max'
+EWMA = 'ewma'
+METHODS = (MAE, MAX, EWMA)
+
+
+class AnomalyScorer(object):
+    """
+    Computes the per-feature reconstruction error of a batch of windows and
+    compares it with the per-feature thresholds.
+        - mae: mean absolute error over all the windows (default)
+        - max: error of the worst window
+        - ewma: mae smoothed over time with an exponentially weighted moving average,
+                tracked separately for each key (i.e. turbine id)
+    The thresholds must be calibrated for the selected method.
+    A scratch buffer is reused across calls, so an instance must not be shared between threads.
+    """
+    def __init__(self, thresholds, method=MAE, alpha=0.3):
+        if method not in METHODS:
+            raise Exception("Invalid anomaly score '%s'. Use one of %s" % (method, METHODS))
+        self.thresholds = np.asarray(thresholds)
+        self.n_features = self.thresholds.shape[-1]
+        self.method = method
+        self.alpha = alpha
+        self.ewma_state = {}
+        self.scratch = None
+
+    @classmethod
+    def from_file(cls, thresholds_path, method=MAE, alpha=0.3):
+        """ Loads the per-feature thresholds from a .npy file (i.e. statistics/thresholds.npy) """
+        return cls(np.load(thresholds_path), method=method, alpha=alpha)
+
+    def window_errors(self, x, p):
+        """
+        Per-window, per-feature mean absolute error.
+        x, p: (..., N, n_features, H, W) -> (..., N, n_features)
+        """
+        if x.shape != p.shape:
+            raise Exception("Input and prediction shapes don't match: %s != %s" % (x.shape, p.shape))
+        dtype = np.result_type(x.dtype, p.dtype)
+        if self.scratch is None or self.scratch.size < x.size or self.scratch.dtype != dtype:
+            self.scratch = np.empty(x.size, dtype=dtype)
+        diff = self.scratch[:x.size].reshape(x.shape)
+        np.subtract(p, x, out=diff)
+        np.abs(diff, out=diff)
+        return diff.reshape(x.shape[:-2] + (-1,)).mean(axis=-1)
+
+    def score(self, x, p, keys=None):
+        """
+        Scores a batch of windows.
+        x, p: (N, n_features, H, W) for one turbine or (T, N, n_features, H, W) for T turbines
+        keys: turbine id (or list of T ids) used to track the ewma state
+        Returns values (..., n_features) and anomalies (..., n_features)
+        """
+        errors = self.window_errors(x, p)
+        if self.method == MAX:
+            values = errors.max(axis=-2)
+        else:
+            values = errors.mean(axis=-2)
+            if self.method == EWMA:
+                values = self.__smooth__(values, keys)
+        anomalies = values > self.thresholds
+        return values, anomalies
+
+    def reset(self, key=None):
+        """ Clears the ewma state of one key or of all of them """
+        if key is None:
+            self.ewma_state = {}
+        else:
+            self.ewma_state.pop(key, None)
+
+    def __smooth__(self, values, keys):
+        batched = values.ndim > 1
+        if not batched:
+            values, keys = values[np.newaxis], [keys]
+        elif keys is None:
+            keys = range(values.shape[0])
+        smoothed = np.empty_like(values)
+        for i, key in enumerate(keys):
+            prev = self.ewma_state.get(key)
+            smoothed[i] = values[i] if prev is None else self.alpha * values[i] + (1.0 - self.alpha) * prev
+            self.ewma_state[key] = smoothed[i]
+        return smoothed if batched else smoothed[0]
@@ -0,0 +1,229 @@
+from contextlib import contextmanager
+import numpy as np
+import pywt
+
+"""
+Feature engineering shared by the training preprocessing, the edge detector and the
+fleet simulator: quaternion -> euler angles, wavelet denoising and the sliding windows
+of the model input (n, features, 10, 10).
+The code is deployed in three places, which must stay identical copies of this file:
+    00-model-build-train/algorithms/preprocessing/signal_processing.py
+    01-model-deploy/algorithms/inference/aws.samples.windturbine.detector/inference/signal_processing.py
+    01-model-deploy/fleet_simulator/signal_processing.py
+algorithms/preprocessing/benchmark.py checks the copies and the results of both paths.
+"""
+
+VERSION = '1.0.0'
+
+# max abs diff between the block-wise and the whole-series denoising, relative to max(abs(data))
+DENOISE_TOLERANCE = 1e-9
+
+
+def euler_from_quaternion(x, y, z, w):
+    """
+    Convert a quaternion into euler angles (roll, pitch, yaw)
+    roll is rotation around x in radians (counterclockwise)
+    pitch is rotation around y in radians (counterclockwise)
+    yaw is rotation around z in radians (counterclockwise)
+    x, y, z, w can be scalars or numpy arrays (column-wise conversion)
+    """
+    t0 = +2.0 * (w * x + y * z)
+    t1 = +1.0 - 2.0 * (x * x + y * y)
+    roll_x = np.arctan2(t0, t1)
+
+    t2 = +2.0 * (w * y - z * x)
+    t2 = np.clip(t2, -1.0, +1.0)
+    pitch_y = np.arcsin(t2)
+
+    t3 = +2.0 * (w * z + x * y)
+    t4 = +1.0 - 2.0 * (y * y + z * z)
+    yaw_z = np.arctan2(t3, t4)
+
+    return roll_x, pitch_y, yaw_z # in radians
+
+
+def wavelet_denoise(data, wavelet, noise_sigma):
+    '''Filter accelerometer data using wavelet denoising
+
+    Modification of F. Blanco-Silva's code at: https://goo.gl/gOQwy5
+    '''
+
+    wavelet = pywt.Wavelet(wavelet)
+    levels  = min(5, (np.floor(np.log2(data.shape[0]))).astype(int))
+
+    # Francisco's code used wavedec2 for image data
+    wavelet_coeffs = pywt.wavedec(data, wavelet, level=levels)
+    threshold = noise_sigma*np.sqrt(2*np.log2(data.size))
+
+    new_wavelet_coeffs = map(lambda x: pywt.threshold(x, threshold, mode='soft'), wavelet_coeffs)
+
+    return pywt.waverec(list(new_wavelet_coeffs), wavelet)
+
+
+def wavelet_denoise_blocks(data, wavelet, noise_sigma, block_size=1048576, out=None):
+    '''Block-wise wavelet_denoise, with constant memory for very long series
+
+    Each block is decomposed with (filter length - 1) * 2^levels samples of overlap on both
+    sides and starts on a multiple of 2^levels, so its coefficients line up with the ones of
+    the whole series. The levels and the threshold are computed on the whole series length.
+    The result matches wavelet_denoise within DENOISE_TOLERANCE * max(abs(data)).
+    data can be a (strided) memmap column and the result can be written into `out`
+    '''
+    n = len(data)
+    wavelet = pywt.Wavelet(wavelet)
+    levels = min(5, int(np.floor(np.log2(n))))
+    threshold = noise_sigma*np.sqrt(2*np.log2(n))
+    align = 2 ** levels
+    overlap = (wavelet.dec_len - 1) * align
+    block_size = n if block_size <= 0 else -(-block_size // align) * align
+    out = np.empty(n) if out is None else out
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        lo, hi = max(0, start - overlap), min(n, end + overlap)
+        coeffs = pywt.wavedec(np.asarray(data[lo:hi], dtype=np.float64), wavelet, level=levels)
+        coeffs = [pywt.threshold(c, threshold, mode='soft') for c in coeffs]
+        out[start:end] = pywt.waverec(coeffs, wavelet)[start - lo:end - lo]
+    return out
+
+
+def count_windows(rows, time_steps, step):
+    """ Number of windows create_dataset builds from a series of `rows` samples """
+    return len(range(0, rows - time_steps, step))
+
+
+def sliding_windows(X, time_steps=1, step=1):
+    """
+    Read-only view (n_windows, time_steps, ...) of the windows of X, without copying it.
+    X is an array (or memmap) with the samples on the first axis
+    """
+    X = np.asarray(X) if not isinstance(X, np.ndarray) else X
+    n_windows = count_windows(len(X), time_steps, step)
+    return np.lib.stride_tricks.as_strided(X, shape=(n_windows, time_steps) + X.shape[1:],
+        strides=(step * X.strides[0],) + X.strides, writeable=False)
+
+
+def create_dataset(X, time_steps=1, step=1):
+    """
+    Encode the timeseries dataset into a
+    multidimentional tensor in the format: num_features x step x step.
+    It uses a time window approach to slide on 'step' right in the timeseries.
+    X can be a DataFrame or an array
+    """
+    X = getattr(X, 'values', X)
+    return np.array(sliding_windows(X, time_steps, step))
+
+
+def to_model_input(windows):
+    """ (n, time_steps, features) windows -> model input (n, features, side, side) """
+    n, time_steps, n_features = windows.shape
+    side = int(round(np.sqrt(time_steps)))
+    return np.transpose(windows, (0, 2, 1)).reshape(n, n_features, side, side)
+
+
+class WindowPreprocessor(object):
+    """
+    Fused float32 version of euler_from_quaternion -> wavelet_denoise -> normalization ->
+    create_dataset, for the latest windows of a buffer of raw samples
+    [qx, qy, qz, qw, wind speed rps, rps, voltage] -> model input (n_windows, n_features, 10, 10).
+    The work buffers are preallocated, so each call only allocates the temporary arrays created inside pywt.
+
+    The returned tensor is a work buffer that is overwritten by the next call,
+    so an instance must not be shared between threads.
+    """
+    def __init__(self, raw_std, mean, std, time_steps, step, n_features=6, num_samples=500,
+                 wavelet='db6', metrics=None):
+        self.side = int(round(np.sqrt(time_steps)))
+        if self.side * self.side != time_steps:
+            raise Exception("time_steps must be a perfect square to build the input tensor: %d" % time_steps)
+
+        self.raw_std = np.asarray(raw_std, dtype=np.float32)
+        self.mean = np.asarray(mean, dtype=np.float32).reshape(n_features, 1)
+        self.std = np.asarray(std, dtype=np.float32).reshape(n_features, 1)
+        self.time_steps = time_steps
+        self.step = step
+        self.n_features = n_features
+        self.wavelet = pywt.Wavelet(wavelet)
+        self.metrics = metrics
+
+        # only the last (time_steps + step) denoised samples are used to build the windows
+        self.tail = time_steps + step
+        self.n_windows = count_windows(self.tail, time_steps, step)
+        self.denoised = np.empty((n_features, self.tail), dtype=np.float32)
+        self.x = np.empty((self.n_windows, n_features, self.side, self.side), dtype=np.float32)
+
+        item = self.denoised.itemsize
+        self.windows = np.lib.stride_tricks.as_strided(self.denoised,
+            shape=(self.n_windows, n_features, time_steps),
+            strides=(step * item, self.tail * item, item), writeable=False)
+
+        self.__allocate__(num_samples)
+
+    def __allocate__(self, num_samples):
+        if num_samples < self.tail:
+            raise Exception("At least %d samples are required, got %d" % (self.tail, num_samples))
+        self.num_samples = num_samples
+        self.raw = np.empty((num_samples, self.n_features + 1), dtype=np.float32)
+        # feature-major, so each feature is contiguous for the wavelet transform
+        self.features = np.empty((self.n_features, num_samples), dtype=np.float32)
+        self.scratch = np.empty((2, num_samples), dtype=np.float32)
+        # the wavelet threshold only depends on the buffer size
+        self.thresholds = self.raw_std * np.float32(np.sqrt(2 * np.log2(num_samples)))
+        self.levels = min(5, int(np.floor(np.log2(num_samples))))
+
+    @contextmanager
+    def __timer__(self, name):
+        if self.metrics is None:
+            yield
+        else:
+            with self.metrics.timer(name):
+                yield
+
+    def __call__(self, buffer):
+        n = len(buffer)
+        if n != self.num_samples:
+            self.__allocate__(n)
+        raw = self.raw
+        raw[...] = buffer
+
+        with self.__timer__('euler'):
+            self.__euler__(raw[:, 0], raw[:, 1], raw[:, 2], raw[:, 3])
+            np.copyto(self.features[3:].T, raw[:, 4:])
+
+        with self.__timer__('denoise'):
+            for i in range(self.n_features):
+                coeffs = pywt.wavedec(self.features[i], self.wavelet, level=self.levels)
+                for c in coeffs:
+                    c[...] = pywt.threshold(c, self.thresholds[i], mode='soft')
+                self.denoised[i] = pywt.waverec(coeffs, self.wavelet)[-self.tail:]
+
+        with self.__timer__('normalize'):
+            np.subtract(self.denoised, self.mean, out=self.denoised)
+            np.divide(self.denoised, self.std, out=self.denoised)
+
+        with self.__timer__('windowing'):
+            np.copyto(self.x.reshape(self.n_windows, self.n_features, self.time_steps), self.windows)
+
+        return self.x
+
+    def __euler__(self, x, y, z, w):
+        """
+        euler_from_quaternion with preallocated buffers, written into features[0:3]
+        """
+        roll, pitch, yaw = self.features[0], self.features[1], self.features[2]
+        a, b = self.scratch[0], self.scratch[1]
+
+        # roll: atan2(2(wx + yz), 1 - 2(x^2 + y^2))
+        np.multiply(w, x, out=a); a += y * z; a *= 2
+        np.multiply(x, x, out=b); b += y * y; b *= -2; b += 1
+        np.arctan2(a, b, out=roll)
+
+        # pitch: asin(clip(2(wy - zx), -1, 1))
+        np.multiply(w, y, out=a); a -= z * x; a *= 2
+        np.clip(a, -1.0, 1.0, out=a)
+        np.arcsin(a, out=pitch)
+
+        # yaw: atan2(2(wz + xy), 1 - 2(y^2 + z^2))
+        np.multiply(w, z, out=a); a += x * y; a *= 2
+        np.multiply(y, y, out=b); b += z * z; b *= -2; b += 1
+        np.arctan2(a, b, out=yaw)
@@ -103,6 +103,8 @@ class WindTurbine(object):
     def __publish_raw_data_forver__(self):
         while self.running:
             self.__read_next_turbine_sample__()
+            # emit time of the sample, used by the inference app to measure the emit-to-alert latency
+            self.data_buffer['ts'] = time.time()
             self.mqtt_client.publish(self.raw_data_topic, self.data_buffer)
             time.sleep(0.02)
     
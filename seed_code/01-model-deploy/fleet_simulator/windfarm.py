@@ -1,14 +1,16 @@
 import threading
-import math
 import random
-import pywt
 import numpy as np
 import logging
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from turbine import WindTurbine
 from edgeagentclient import EdgeAgentClient
 from ota import OTAModelUpdate
+from scheduler import RateScheduler
+from scoring import AnomalyScorer
+from signal_processing import WindowPreprocessor
 
 class WindTurbineFarm(object):
     """ 
@@ -20,7 +22,8 @@ class WindTurbineFarm(object):
         - Launch a Edge Agent Client that integrates the Wind Turbine with the Edge Device
         - Display the UI
     """
-    def __init__(self, simulator, mqtt_host, mqtt_port):
+    def __init__(self, simulator, mqtt_host, mqtt_port, detection_interval=0.5, detection_policy='skip',
+                 max_workers=None, agent_sockets=None, anomaly_score='mae', ewma_alpha=0.3, batch_across_agents=False):
         if simulator is None:
             raise Exception("You need to pass the simulator as argument")
 
@@ -30,8 +33,21 @@ class WindTurbineFarm(object):
         self.mqtt_host = mqtt_host
         self.mqtt_port = mqtt_port
 
-        ## launch edge agent clients
-        self.edge_agents = [EdgeAgentClient('/tmp/agent%d' % i) for i in range(self.n_turbines)]
+        ## launch edge agent clients, one channel per agent socket.
+        ## The windows of the turbines configured with the same socket (sharing the channel) and
+        ## model are batched into one predict call; each agent runs its own calls, in parallel.
+        ## With batch_across_agents, the windows of all the turbines running the same model (name
+        ## and version) are batched on the agent of one of them, but only if the model was compiled
+        ## with a batch dim > 1 or dynamic: a batch 1 model would run them one by one on that agent
+        if agent_sockets is None:
+            agent_sockets = ['/tmp/agent%d' % i for i in range(self.n_turbines)]
+        if len(agent_sockets) != self.n_turbines:
+            raise Exception("You need to pass one agent socket per turbine")
+        self.agent_sockets = agent_sockets
+        self.batch_across_agents = batch_across_agents
+        clients = {}
+        for s in set(agent_sockets): clients[s] = EdgeAgentClient(s)
+        self.edge_agents = [clients[s] for s in agent_sockets]
         self.model_meta = [{'model_name':None} for i in range(self.n_turbines)]
         self.ota_devices = []
 
@@ -43,6 +59,7 @@ class WindTurbineFarm(object):
         # then we load the thresholds computed in the training notebook
         # for more info, take a look on the Notebook #2
         self.thresholds = np.load('../../../statistics/thresholds.npy')
+        self.scorer = AnomalyScorer(self.thresholds, method=anomaly_score, alpha=ewma_alpha)
         
         # configurations to format the time based data for the anomaly detection model
         # If you change these parameters you need to retrain your model with the new parameters        
@@ -57,77 +74,26 @@ class WindTurbineFarm(object):
         
         # minimal buffer length for denoising. We need to accumulate some sample before denoising
         self.min_num_samples = 500
+        self.preprocessors = [WindowPreprocessor(self.raw_std, self.mean, self.std, self.TIME_STEPS, self.STEP,
+                                                 self.n_features, self.min_num_samples) for i in range(self.n_turbines)]
 
-    def __create_dataset__(self, X, time_steps=1, step=1):
-        """
-        This encodes a list of readings into the correct shape
-        expected by the model. It uses the concept of a sliding window
-        """
-        Xs = []
-        for i in range(0, len(X) - time_steps, step):
-            v = X[i:(i + time_steps)]
-            Xs.append(v)
-        return np.array(Xs)
+        # target cadence of the detection loop and what to do when it gets late
+        self.scheduler = RateScheduler(detection_interval, detection_policy)
 
-    def __euler_from_quaternion__(self, x, y, z, w):
-        """
-        Convert a quaternion into euler angles (roll, pitch, yaw)
-        roll is rotation around x in radians (counterclockwise)
-        pitch is rotation around y in radians (counterclockwise)
-        yaw is rotation around z in radians (counterclockwise)
-        """
-        t0 = +2.0 * (w * x + y * z)
-        t1 = +1.0 - 2.0 * (x * x + y * y)
-        roll_x = math.atan2(t0, t1)
+        # worker pool used to process the turbines in parallel
+        self.max_workers = max_workers if max_workers is not None else min(32, self.n_turbines)
+        self.pool = None
 
-        t2 = +2.0 * (w * y - z * x)
-        t2 = +1.0 if t2 > +1.0 else t2
-        t2 = -1.0 if t2 < -1.0 else t2
-        pitch_y = math.asin(t2)
-
-        t3 = +2.0 * (w * z + x * y)
-        t4 = +1.0 - 2.0 * (y * y + z * z)
-        yaw_z = math.atan2(t3, t4)
-
-        return roll_x, pitch_y, yaw_z # in radians
-        
-    def __wavelet_denoise__(self, data, wavelet, noise_sigma):
-        '''
-        Filter accelerometer data using wavelet denoising
-        Modification of F. Blanco-Silva's code at: https://goo.gl/gOQwy5
-        '''
-
-        wavelet = pywt.Wavelet(wavelet)
-        levels  = min(5, (np.floor(np.log2(data.shape[0]))).astype(int))
-
-        # Francisco's code used wavedec2 for image data
-        wavelet_coeffs = pywt.wavedec(data, wavelet, level=levels)
-        threshold = noise_sigma*np.sqrt(2*np.log2(data.size))
-
-        new_wavelet_coeffs = map(lambda x: pywt.threshold(x, threshold, mode='soft'), wavelet_coeffs)
-
-        return pywt.waverec(list(new_wavelet_coeffs), wavelet)
+        # aggregate throughput of the detection loop
+        self.report_interval = 10 # seconds
+        self.windows_per_second = 0.0
+        self.windows_count = 0
+        self.windows_report_time = time.time()
 
     def __del__(self):
         """Destructor"""
         self.halt()
 
-    def __data_prep__(self, turbine_id, buffer):
-        """
-        This method is called for each reading.
-        Here we do some data prep and accumulate the data in the buffer
-        for denoising
-        """
-        new_buffer = []
-        for data in buffer:
-            roll,pitch,yaw = self.__euler_from_quaternion__(
-                data[self.feature_ids[0]],data[self.feature_ids[1]],
-                data[self.feature_ids[2]],data[self.feature_ids[3]]
-            )
-            row = [roll,pitch,yaw, data[self.feature_ids[4]],data[self.feature_ids[5]], data[self.feature_ids[6]]]
-            new_buffer.append(row)
-        return np.array(new_buffer)
-            
     def __detect_anomalies__(self):     
         """
         Keeps processing the data collected from the turbines
@@ -135,48 +101,100 @@ class WindTurbineFarm(object):
         anomalies detected (through a callback)
         """
         while self.running:
-            # for each turbine, check the buffer
-            start_time = time.time()
-            for idx in range(self.n_turbines): 
-                if self.simulator.is_turbine_running(idx):
-                    buffer = self.simulator.get_raw_data(idx)
-                    if len(buffer) >= self.min_num_samples:
-                        self.simulator.update_dashboard(idx, np.array(buffer))
-                        # create a copy & prep the data
-                        data = self.__data_prep__(idx, np.array(buffer) )
-                        
-                        if not self.edge_agents[idx].is_model_loaded(self.model_meta[idx]['model_name']):
-                            self.simulator.update_label(idx, 'Model not loaded')
-                            continue
-                        
-                        # denoise
-                        data = np.array([self.__wavelet_denoise__(data[:,i], 'db6', self.raw_std[i]) for i in range(self.n_features)])
-                        data = data.transpose((1,0))
-
-                        # normalize                     
-                        data -= self.mean
-                        data /= self.std
-                        data = data[-(self.TIME_STEPS+self.STEP):]
-
-                        # create the dataset and reshape it
-                        x = self.__create_dataset__(data, self.TIME_STEPS, self.STEP)                    
-                        x = np.transpose(x, (0, 2, 1)).reshape(x.shape[0], self.n_features, 10, 10)
-
-                        # run the model                    
-                        p = self.edge_agents[idx].predict(self.model_meta[idx]['model_name'], x)
-                        if p is not None:
-                            a = x.reshape(x.shape[0], self.n_features, 100).transpose((0,2,1))
-                            b = p.reshape(p.shape[0], self.n_features, 100).transpose((0,2,1))
-                            # check the anomalies
-                            pred_mae_loss = np.mean(np.abs(b - a), axis=1).transpose((1,0))
-
-                            values = np.mean(pred_mae_loss, axis=1)
-                            anomalies = (values > self.thresholds)
-
-                            self.simulator.detected_anomalies(idx, values, anomalies)
-                        
-            elapsed_time = time.time() - start_time
-            time.sleep(0.5-elapsed_time)
+            self.scheduler.wait()
+            try:
+                with self.scheduler.run():
+                    self.__detect_anomalies_once__()
+            except Exception as e:
+                logging.exception(e)
+
+    def __detect_anomalies_once__(self):
+        """
+        One pass of the detection loop over all the turbines.
+        The windows are prepared in parallel (one task per turbine), then the ready windows
+        of each agent (see batch_across_agents) that run the same model are merged into a single
+        batched prediction. The groups run in parallel, in the worker pool
+        """
+        running = [idx for idx in range(self.n_turbines) if self.simulator.is_turbine_running(idx)]
+        windows = [w for w in self.pool.map(self.__prepare_window__, running) if w is not None]
+
+        # group the windows by edge agent & model: each group is a single (batched) predict call
+        groups = {}
+        for idx, x in windows:
+            model_name = self.model_meta[idx]['model_name']
+            key = (model_name, self.model_meta[idx].get('model_version'))
+            if not self.batch_across_agents or self.edge_agents[idx].get_batch_size(model_name) == 1:
+                key = (self.agent_sockets[idx],) + key
+            groups.setdefault(key, []).append((idx, x))
+
+        results = [r for group in self.pool.map(self.__predict_group__, groups.values()) for r in group]
+        if len(results) == 0:
+            self.__update_throughput__(len(windows))
+            return
+
+        # check the anomalies of all the turbines at once
+        ids = [r[0] for r in results]
+        if len(set(r[1].shape for r in results)) == 1:
+            values, anomalies = self.scorer.score(
+                np.stack([r[1] for r in results]), np.stack([r[2] for r in results]), keys=ids)
+        else:
+            scores = [self.scorer.score(x, p, keys=idx) for idx, x, p in results]
+            values, anomalies = [s[0] for s in scores], [s[1] for s in scores]
+
+        for i, idx in enumerate(ids):
+            self.simulator.detected_anomalies(idx, values[i], anomalies[i])
+
+        self.__update_throughput__(len(windows))
+
+    def __prepare_window__(self, idx):
+        """
+        Prepares the input tensor of a turbine.
+        Returns (idx, x) or None if the turbine has no window ready
+        """
+        buffer = np.array(self.simulator.get_raw_data(idx))
+        if len(buffer) < self.min_num_samples:
+            return None
+        self.simulator.update_dashboard(idx, buffer)
+
+        if not self.edge_agents[idx].is_model_loaded(self.model_meta[idx]['model_name']):
+            self.simulator.update_label(idx, 'Model not loaded')
+            return None
+
+        # euler, denoise, normalize & create the dataset: the same code of the detector.
+        # Each turbine has its own preprocessor, since it reuses its buffers
+        x = self.preprocessors[idx](buffer[:, self.feature_ids])
+        return idx, x.copy()
+
+    def __predict_group__(self, windows):
+        """
+        Runs the model once for all the windows of a group, on the edge agent of the
+        first turbine (the agent of all of them, unless batch_across_agents): all of them
+        have the same model loaded. Returns a list of (idx, x, p)
+        """
+        idx = windows[0][0]
+        x = np.concatenate([w[1] for w in windows])
+        p = self.edge_agents[idx].predict_batch(self.model_meta[idx]['model_name'], x)
+        if p is None:
+            return []
+        results = []
+        offset = 0
+        for idx, x in windows:
+            results.append((idx, x, p[offset:offset + x.shape[0]]))
+            offset += x.shape[0]
+        return results
+
+    def __update_throughput__(self, num_windows):
+        """
+        Accumulates the processed windows and reports the aggregate windows/second
+        """
+        self.windows_count += num_windows
+        elapsed_time = time.time() - self.windows_report_time
+        if elapsed_time >= self.report_interval:
+            self.windows_per_second = self.windows_count / elapsed_time
+            logging.info("Anomaly detection throughput: %.02f windows/s (%d turbines, %d workers)" % (
+                self.windows_per_second, self.n_turbines, self.max_workers))
+            self.windows_count = 0
+            self.windows_report_time = time.time()
 
     def notify_model_update(self, device_id, model_name, model_version):
         logging.info("Loading model %s version %f in device %d" % ( model_name, model_version, device_id))
@@ -215,6 +233,7 @@ class WindTurbineFarm(object):
 
             logging.info("Starting the anomaly detector loop...")
             # finally start the anomaly detection loop
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
             
             self.processing = threading.Thread(target=self.__detect_anomalies__)
             self.processing.start()
@@ -233,3 +252,4 @@ class WindTurbineFarm(object):
             # stop the anomaly detector        
             
             self.processing.join()
+            self.pool.shutdown()